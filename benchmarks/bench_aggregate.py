@@ -0,0 +1,74 @@
+"""
+对比 FaissIndex.search 中结果聚合的旧实现（Python 循环）与 NumPy 实现
+
+python benchmarks/bench_aggregate.py -q 500 -k 3
+"""
+
+import timeit
+from collections import defaultdict
+
+import click
+import numpy as np
+
+from index.index.index import aggregate_matches, wilson_score
+
+
+def aggregate_loop(labels: np.ndarray, distances: np.ndarray, limit: int):
+    labels = labels >> 10
+    kds = defaultdict(list)
+    for label, distance in zip(labels, distances):
+        t = defaultdict(lambda: 256)
+        for l, d in zip(label, distance):
+            t[l] = min(t[l], d)
+        for l, d in t.items():
+            kds[l].append(d)
+
+    kls = sorted(kds.items(), key=lambda x: len(x[1]), reverse=True)
+    kws = sorted(
+        [(k, wilson_score(np.array(v))) for k, v in kls[: 2 * limit]],
+        key=lambda x: x[1],
+        reverse=True,
+    )
+    return kws[:limit]
+
+
+def make_labels(nq: int, k: int, nimages: int, seed: int):
+    rng = np.random.default_rng(seed)
+    # 少量图片集中命中，模拟真实查询中目标图片的匹配
+    hot = rng.integers(0, nimages, 5)
+    images = np.where(
+        rng.random((nq, k)) < 0.3,
+        rng.choice(hot, (nq, k)),
+        rng.integers(0, nimages, (nq, k)),
+    )
+    labels = images.astype(np.int64) << 10 | rng.integers(0, 500, (nq, k))
+    distances = np.sort(rng.integers(0, 100, (nq, k)), axis=1).astype(np.int32)
+    return labels, distances
+
+
+@click.command()
+@click.option("-q", "--nq", default=500, show_default=True, help="查询特征点数量")
+@click.option("-k", default=3, show_default=True, help="每个特征点的近邻数量")
+@click.option("-l", "--limit", default=10, show_default=True, help="返回结果数量")
+@click.option("--images", default=100000, show_default=True, help="图片总数")
+@click.option("--repeat", default=200, show_default=True, help="重复次数")
+def main(nq: int, k: int, limit: int, images: int, repeat: int):
+    labels, distances = make_labels(nq, k, images, 0)
+
+    old = aggregate_loop(labels, distances, limit)
+    new = aggregate_matches(labels, distances, limit)
+    assert old == new, (old, new)
+
+    t_old = timeit.timeit(
+        lambda: aggregate_loop(labels, distances, limit), number=repeat
+    )
+    t_new = timeit.timeit(
+        lambda: aggregate_matches(labels, distances, limit), number=repeat
+    )
+    print(f"nq={nq} k={k} limit={limit}")
+    print(f"loop:  {t_old / repeat * 1000:.3f} ms")
+    print(f"numpy: {t_new / repeat * 1000:.3f} ms ({t_old / t_new:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+对比不同的每张图片特征点数量上限（build --max-descriptors）构建的索引大小、召回率和搜索开销
+
+每个上限都从训练文件在内存中构建一个完整的索引，不会修改数据库目录中的索引
+
+python benchmarks/bench_budget.py -d data --description BIVF4096
+python benchmarks/bench_budget.py -d data --description BIVF4096 -b 500 -b 200 -b 100
+"""
+
+from pathlib import Path
+
+import click
+from loguru import logger
+
+from index.bench import DISTORTIONS, make_queries, run_bench, sample_images
+from index.database import FlatVectorStore, VectorReader, connect, crud
+from index.index import FaissIndex, FaissIndexManager
+from index.index.index import DEFAULT_SEARCH_PARAMS
+
+
+def build_in_memory(
+    train_path: Path,
+    store: FlatVectorStore | None,
+    limit: int | None,
+    max_descriptors: int | None,
+) -> FaissIndex:
+    index = FaissIndex(str(train_path))
+    reader = VectorReader(1, None, limit, store=store, max_descriptors=max_descriptors)
+    for r in reader:
+        index.add_with_ids(r.vectors, r.xids)
+    return index
+
+
+@click.command()
+@click.option("-d", "--db-dir", type=click.Path(path_type=Path), required=True)
+@click.option("--description", required=True, help="训练文件对应的索引描述")
+@click.option(
+    "-b",
+    "--budget",
+    multiple=True,
+    type=int,
+    default=[0, 400, 300, 200, 100],
+    show_default=True,
+    help="每张图片最多添加的特征点数量，0 为不限制",
+)
+@click.option("-l", "--limit", type=int, help="只使用前多少张图片")
+@click.option("-q", "--queries", default=100, show_default=True, help="查询图片数量")
+@click.option(
+    "--distortion",
+    multiple=True,
+    type=click.Choice(list(DISTORTIONS)),
+    default=list(DISTORTIONS),
+    show_default=True,
+)
+@click.option("--nprobe", default=DEFAULT_SEARCH_PARAMS["nprobe"], show_default=True)
+@click.option("-k", default=DEFAULT_SEARCH_PARAMS["k"], show_default=True)
+@click.option("--seed", default=0, show_default=True)
+def main(
+    db_dir: Path,
+    description: str,
+    budget: list[int],
+    limit: int | None,
+    queries: int,
+    distortion: list[str],
+    nprobe: int,
+    k: int,
+    seed: int,
+):
+    connect(str(db_dir), readonly=True)
+    train_path = FaissIndexManager(db_dir, description).train_path
+    store = FlatVectorStore.open(db_dir)
+
+    max_id = crud.image.max_id() if limit is None else limit
+    query_set = make_queries(sample_images(queries, max_id, seed), distortion, seed)
+    if not query_set:
+        raise click.UsageError("没有可用的查询图片")
+    logger.info("{} 个查询", len(query_set))
+
+    params = {**DEFAULT_SEARCH_PARAMS, "nprobe": nprobe, "k": k}
+    rows = []
+    for b in budget:
+        index = build_in_memory(train_path, store, limit, b or None)
+        ntotal = index.index.ntotal
+        # 倒排表中每个特征点占用编码和 8 字节 ID
+        size = ntotal * (index.index.code_size + 8)
+        r = run_bench(index, query_set, [params])[0]
+        rows.append((b or "全部", ntotal, size, r))
+
+    base = rows[0][2]
+    print(
+        f"{'上限':>6} {'特征点':>10} {'倒排表 MB':>10} {'占比':>6} "
+        f"{'R@1':>6} {'R@10':>6} {'p50 ms':>7} {'p95 ms':>7} {'ndis':>9}"
+    )
+    for b, ntotal, size, r in rows:
+        print(
+            f"{b!s:>6} {ntotal:>10} {size / 2**20:>10.1f} {size / base:>6.1%} "
+            f"{r.recall_at_1:>6.3f} {r.recall_at_limit:>6.3f} "
+            f"{r.p50:>7.2f} {r.p95:>7.2f} {r.ndis:>9.0f}"
+        )
+    for b, _, _, r in rows:
+        detail = "，".join(f"{n} {v:.3f}" for n, v in r.recall_by_distortion.items())
+        print(f"{b!s:>6} R@1：{detail}")
+
+
+if __name__ == "__main__":
+    main()
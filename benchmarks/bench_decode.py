@@ -0,0 +1,193 @@
+"""
+对比完整解码后缩放与 JPEG 缩小解码（IMREAD_REDUCED_GRAYSCALE_*）的耗时，并检查两者提取的
+ORB 特征点是否等价：同一位置的特征点描述子是否相近，以及（可选）在索引中的搜索结果是否相同
+
+python benchmarks/bench_decode.py images/
+python benchmarks/bench_decode.py --synthetic 20
+python benchmarks/bench_decode.py -d data -n image --queries 100
+"""
+
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import click
+import cv2
+import faiss
+import numpy as np
+
+from index.feature import FeatureExtractorPool, default_scale_factor
+from index.scan import read_path
+from index.utils import jpeg_size, load_image, reduced_flag
+
+
+def decode_time(data: list[bytes], reduced: bool, repeat: int) -> float:
+    """
+    解码所有图片的平均耗时，单位毫秒
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = perf_counter()
+        for d in data:
+            load_image(d, reduced=reduced)
+        best = min(best, perf_counter() - t0)
+    return best / len(data) * 1000
+
+
+def match_ratio(
+    kps1: list[cv2.KeyPoint],
+    des1: np.ndarray,
+    kps2: list[cv2.KeyPoint],
+    des2: np.ndarray,
+    max_distance: int,
+    max_offset: float,
+) -> float:
+    """
+    des1 中能在 des2 里找到位置相近且汉明距离不超过 max_distance 的特征点的比例
+    """
+    if len(des1) == 0 or len(des2) == 0:
+        return 0.0
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING).match(des1, des2)
+    good = 0
+    for m in matches:
+        p1 = np.array(kps1[m.queryIdx].pt)
+        p2 = np.array(kps2[m.trainIdx].pt)
+        if m.distance <= max_distance and np.linalg.norm(p1 - p2) <= max_offset:
+            good += 1
+    return good / len(des1)
+
+
+def self_retrieval(
+    base: list[np.ndarray], queries: list[np.ndarray], max_distance: int = 64
+) -> int:
+    """
+    暴力搜索每个查询的最近邻，按图片统计距离不超过 max_distance 的匹配数，返回第一名正确的数量
+    """
+    flat = faiss.IndexBinaryFlat(256)
+    labels = []
+    for i, des in enumerate(base):
+        if len(des):
+            flat.add(des)
+            labels.append(np.full(len(des), i))
+    labels = np.concatenate(labels)
+
+    hits = 0
+    for i, des in enumerate(queries):
+        if not len(des):
+            continue
+        distances, nn = flat.search(des, 1)
+        votes = np.bincount(labels[nn[distances <= max_distance]], minlength=len(base))
+        hits += int(votes.argmax() == i)
+    return hits
+
+
+def make_synthetic(n: int, output: Path) -> list[Path]:
+    from index.bench import generate_synthetic
+
+    # 与扫描件相近的尺寸
+    return generate_synthetic(output, n, width=3000, height=4500)
+
+
+@click.command()
+@click.argument("IMAGES", nargs=-1, type=click.Path(exists=True, path_type=Path))
+@click.option("--synthetic", default=0, help="生成指定数量的大尺寸随机图片用于测试")
+@click.option("-d", "--db-dir", type=click.Path(path_type=Path), help="数据库目录")
+@click.option("-n", "--name", help="索引名称，指定后比较两种解码方式的搜索结果")
+@click.option("--queries", default=50, show_default=True, help="从索引中选择的图片数量")
+@click.option("--repeat", default=3, show_default=True, help="重复次数")
+@click.option("--max-distance", default=32, show_default=True, help="描述子相近的阈值")
+@click.option("--max-offset", default=2.0, show_default=True, help="位置相近的阈值")
+def main(
+    images: tuple[Path, ...],
+    synthetic: int,
+    db_dir: Path | None,
+    name: str | None,
+    queries: int,
+    repeat: int,
+    max_distance: int,
+    max_offset: float,
+):
+    paths = []
+    for p in images:
+        paths += sorted(p.rglob("*.jpg")) if p.is_dir() else [p]
+    tmp = None
+    if synthetic:
+        tmp = tempfile.TemporaryDirectory()
+        paths += make_synthetic(synthetic, Path(tmp.name))
+    data = [p.read_bytes() for p in paths]
+
+    index, image_ids = None, []
+    if db_dir is not None and name is not None:
+        from index.bench import sample_images
+        from index.commands.bench import indexed_max_id
+        from index.database import connect
+        from index.index import FaissIndexManager
+
+        connect(str(db_dir), vector=False, readonly=True)
+        m = FaissIndexManager(db_dir)
+        index = m.get_index(name)
+        for image_id, path in sample_images(queries, indexed_max_id(m, name)):
+            # 路径可能指向压缩包中的图片
+            if (d := read_path(path)) is None:
+                continue
+            data.append(d)
+            image_ids.append(image_id)
+    # 不在索引中的图片为 None
+    image_ids = [None] * (len(data) - len(image_ids)) + image_ids
+
+    if not data:
+        raise click.UsageError("没有图片")
+    reducible = sum(
+        1
+        for d in data
+        if (size := jpeg_size(d)) and reduced_flag(*size) != cv2.IMREAD_GRAYSCALE
+    )
+    print(f"{len(data)} 张图片，{reducible} 张可以缩小解码")
+
+    t_full = decode_time(data, False, repeat)
+    t_reduced = decode_time(data, True, repeat)
+    print(f"完整解码: {t_full:.2f} ms/张")
+    print(f"缩小解码: {t_reduced:.2f} ms/张 ({t_full / t_reduced:.2f}x)")
+
+    extractors = FeatureExtractorPool()
+    full, reduced = [], []
+    for d in data:
+        for out, flag in ((full, False), (reduced, True)):
+            img = load_image(d, reduced=flag)
+            with extractors.get(default_scale_factor(img)) as ft:
+                out.append(ft.detect_and_compute(img))
+
+    ratios = np.array(
+        [
+            match_ratio(kps1, des1, kps2, des2, max_distance, max_offset)
+            for (kps1, des1), (kps2, des2) in zip(full, reduced)
+        ]
+    )
+    print(
+        f"特征点一致比例: 平均 {ratios.mean():.3f}，最低 {ratios.min():.3f}"
+        f"（距离 <= {max_distance}，位置偏差 <= {max_offset}px）"
+    )
+
+    # 以完整解码的特征点为库，用缩小解码的特征点检索，第一名应当是同一张图片
+    hits = self_retrieval([des for _, des in full], [des for _, des in reduced])
+    print(f"缩小解码检索到原图: {hits}/{len(data)}")
+
+    if index is not None:
+        found = [0, 0]
+        for (_, des1), (_, des2), image_id in zip(full, reduced, image_ids):
+            if image_id is None:
+                continue
+            for i, des in enumerate((des1, des2)):
+                r = index.search(des, 1).result if len(des) else []
+                found[i] += bool(r and r[0][0] == image_id)
+        total = sum(image_id is not None for image_id in image_ids)
+        print(
+            f"索引搜索第一名正确: 完整解码 {found[0]}/{total}，缩小解码 {found[1]}/{total}"
+        )
+
+    if tmp is not None:
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
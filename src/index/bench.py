@@ -0,0 +1,329 @@
+import itertools
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from time import perf_counter
+from typing import Callable
+
+import cv2
+import numpy as np
+from cv2.typing import MatLike
+from loguru import logger
+
+from .database import crud
+from .feature import FeatureExtractorPool, default_scale_factor
+from .index import FaissIndex, ShardedFaissIndex
+from .scan import read_path
+from .utils import load_image
+
+__all__ = [
+    "DISTORTIONS",
+    "BenchResult",
+    "Query",
+    "format_table",
+    "generate_synthetic",
+    "make_queries",
+    "param_grid",
+    "pareto_front",
+    "run_bench",
+    "sample_images",
+    "tune",
+]
+
+
+def _rescale(img: MatLike, rng: np.random.Generator) -> MatLike:
+    scale = rng.uniform(0.4, 0.7)
+    return cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def _crop(img: MatLike, rng: np.random.Generator) -> MatLike:
+    h, w = img.shape[:2]
+    ch, cw = int(h * rng.uniform(0.7, 0.9)), int(w * rng.uniform(0.7, 0.9))
+    y, x = rng.integers(0, h - ch + 1), rng.integers(0, w - cw + 1)
+    return img[y : y + ch, x : x + cw]
+
+
+def _jpeg(img: MatLike, rng: np.random.Generator) -> MatLike:
+    quality = int(rng.integers(20, 50))
+    _, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE)
+
+
+# 查询图片的变换，original 为原图
+DISTORTIONS: dict[str, Callable[[MatLike, np.random.Generator], MatLike]] = {
+    "original": lambda img, rng: img,
+    "rescale": _rescale,
+    "crop": _crop,
+    "jpeg": _jpeg,
+}
+
+
+@dataclass
+class Query:
+    image_id: int
+    distortion: str
+    descriptors: np.ndarray
+
+
+@dataclass
+class BenchResult:
+    params: dict[str, int]
+    recall_at_1: float
+    recall_at_limit: float
+    # 单次搜索的延迟，单位毫秒
+    p50: float
+    p95: float
+    p99: float
+    # 每次搜索的平均访问倒排表数量和距离计算次数
+    nlist: float
+    ndis: float
+    # 每种变换的 recall@1
+    recall_by_distortion: dict[str, float] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def sample_images(
+    n: int, max_id: int, seed: int | None = None
+) -> list[tuple[int, str]]:
+    """
+    从 [1, max_id] 中随机选择最多 n 张图片，返回 (图片 ID, 路径)
+    """
+    rng = np.random.default_rng(seed)
+    ids = rng.permutation(np.arange(1, max_id + 1))
+    result = []
+    for i in range(0, len(ids), max(n, 100)):
+        batch = ids[i : i + max(n, 100)].tolist()
+        paths = crud.image.get_paths(batch)
+        result += [(id_, paths[id_]) for id_ in batch if id_ in paths]
+        if len(result) >= n:
+            break
+    return result[:n]
+
+
+def make_queries(
+    images: list[tuple[int, str]],
+    distortions: list[str],
+    seed: int | None = None,
+) -> list[Query]:
+    """
+    对每张图片应用每种变换并提取特征点，跳过无法读取或没有特征点的图片
+    """
+    rng = np.random.default_rng(seed)
+    extractors = FeatureExtractorPool()
+    queries = []
+    for image_id, path in images:
+        # 路径可能指向压缩包中的图片
+        data = read_path(path)
+        img = load_image(data) if data is not None else None
+        if img is None:
+            logger.warning("无法读取图片 {}", path)
+            continue
+        for name in distortions:
+            distorted = DISTORTIONS[name](img, rng)
+            with extractors.get(default_scale_factor(distorted)) as ft:
+                _, des = ft.detect_and_compute(distorted)
+            if len(des):
+                queries.append(Query(image_id, name, des))
+    return queries
+
+
+def param_grid(
+    nprobe: list[int],
+    k: list[int],
+    max_codes: list[int],
+    ef_search: list[int],
+) -> list[dict[str, int]]:
+    """
+    搜索参数的所有组合
+    """
+    return [
+        {"nprobe": p, "k": kk, "max_codes": c, "efSearch": e}
+        for p, kk, c, e in itertools.product(nprobe, k, max_codes, ef_search)
+    ]
+
+
+def run_bench(
+    index: FaissIndex | ShardedFaissIndex,
+    queries: list[Query],
+    grid: list[dict[str, int]],
+    limit: int = 10,
+) -> list[BenchResult]:
+    """
+    对每组参数依次执行所有查询，统计召回率、延迟和搜索开销
+    """
+    results = []
+    for params in grid:
+        # 预热，避免首次访问 mmap 的页面影响延迟
+        index.search(queries[0].descriptors, limit, **params)
+
+        latency = np.empty(len(queries))
+        nlist = np.empty(len(queries))
+        ndis = np.empty(len(queries))
+        rank = np.full(len(queries), -1)
+        for i, q in enumerate(queries):
+            t0 = perf_counter()
+            r = index.search(q.descriptors, limit, **params)
+            latency[i] = (perf_counter() - t0) * 1000
+            nlist[i] = r.nlist
+            ndis[i] = r.ndis
+            ids = [id_ for id_, _ in r.result]
+            if q.image_id in ids:
+                rank[i] = ids.index(q.image_id)
+
+        by_distortion = {}
+        kinds = np.array([q.distortion for q in queries])
+        for name in dict.fromkeys(kinds):
+            by_distortion[name] = float(np.mean(rank[kinds == name] == 0))
+        p50, p95, p99 = np.percentile(latency, [50, 95, 99])
+        results.append(
+            BenchResult(
+                params=params,
+                recall_at_1=float(np.mean(rank == 0)),
+                recall_at_limit=float(np.mean(rank >= 0)),
+                p50=float(p50),
+                p95=float(p95),
+                p99=float(p99),
+                nlist=float(nlist.mean()),
+                ndis=float(ndis.mean()),
+                recall_by_distortion=by_distortion,
+            )
+        )
+    return results
+
+
+def pareto_front(results: list[BenchResult]) -> list[BenchResult]:
+    """
+    召回率和 p95 延迟的 Pareto 前沿：没有其他参数在两者上都不差于它，按延迟升序
+    """
+    front = []
+    for r in sorted(results, key=lambda r: (r.p95, -r.recall_at_1)):
+        if not front or r.recall_at_1 > front[-1].recall_at_1:
+            front.append(r)
+    return front
+
+
+def tune(
+    index: FaissIndex | ShardedFaissIndex,
+    queries: list[Query],
+    grid: list[dict[str, int]],
+    limit: int = 10,
+    target_recall: float | None = None,
+    latency_budget: float | None = None,
+) -> tuple[BenchResult | None, list[BenchResult]]:
+    """
+    寻找满足目标的最优搜索参数，返回 (最优参数, Pareto 前沿)
+
+    指定 target_recall 时选择 recall@1 达标且延迟最低的参数，否则选择 p95 延迟不超过
+    latency_budget（毫秒）且召回率最高的参数，两者都指定时需同时满足。其他参数相同时，
+    nprobe 越大召回率越高、延迟越大，因此达到目标召回率或超出延迟预算后不再尝试更大的 nprobe
+    """
+    groups: dict[tuple, list[dict[str, int]]] = {}
+    for params in grid:
+        key = (params["k"], params["max_codes"], params["efSearch"])
+        groups.setdefault(key, []).append(params)
+
+    results = []
+    for group in groups.values():
+        for params in sorted(group, key=lambda p: p["nprobe"]):
+            r = run_bench(index, queries, [params], limit)[0]
+            logger.info("{}: R@1 {:.3f}，p95 {:.2f} ms", params, r.recall_at_1, r.p95)
+            results.append(r)
+            if target_recall is not None and r.recall_at_1 >= target_recall:
+                break
+            if latency_budget is not None and r.p95 > latency_budget:
+                break
+
+    front = pareto_front(results)
+    candidates = [
+        r
+        for r in front
+        if (target_recall is None or r.recall_at_1 >= target_recall)
+        and (latency_budget is None or r.p95 <= latency_budget)
+    ]
+    if not candidates:
+        return None, front
+    if target_recall is not None:
+        return min(candidates, key=lambda r: r.p95), front
+    return max(candidates, key=lambda r: r.recall_at_1), front
+
+
+def format_table(results: list[BenchResult], limit: int) -> str:
+    """
+    将结果格式化为文本表格
+    """
+    distortions = list(results[0].recall_by_distortion) if results else []
+    header = [
+        "nprobe",
+        "k",
+        "max_codes",
+        "efSearch",
+        "R@1",
+        f"R@{limit}",
+        "p50(ms)",
+        "p95(ms)",
+        "p99(ms)",
+        "nlist",
+        "ndis",
+        *(f"R@1:{name}" for name in distortions),
+    ]
+    rows = [
+        [
+            str(r.params["nprobe"]),
+            str(r.params["k"]),
+            str(r.params["max_codes"]),
+            str(r.params["efSearch"]),
+            f"{r.recall_at_1:.3f}",
+            f"{r.recall_at_limit:.3f}",
+            f"{r.p50:.2f}",
+            f"{r.p95:.2f}",
+            f"{r.p99:.2f}",
+            f"{r.nlist:.0f}",
+            f"{r.ndis:.0f}",
+            *(f"{r.recall_by_distortion[name]:.3f}" for name in distortions),
+        ]
+        for r in results
+    ]
+    widths = [max(len(row[i]) for row in [header, *rows]) for i in range(len(header))]
+    lines = [
+        " ".join(c.rjust(w) for c, w in zip(row, widths)) for row in [header, *rows]
+    ]
+    lines.insert(1, " ".join("-" * w for w in widths))
+    return "\n".join(lines)
+
+
+def generate_synthetic(
+    output: Path, n: int, width: int = 640, height: int = 480, seed: int = 0
+) -> list[Path]:
+    """
+    生成 n 张由随机图形和文字组成的图片，用于在没有真实数据时测试添加、构建和搜索
+    """
+    rng = np.random.default_rng(seed)
+    output.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(n):
+        img = rng.integers(0, 64, (height, width, 3), dtype=np.uint8)
+        img = cv2.GaussianBlur(img, (5, 5), 0)
+        for _ in range(int(rng.integers(20, 40))):
+            color = tuple(int(c) for c in rng.integers(0, 256, 3))
+            x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+            shape = rng.integers(0, 4)
+            if shape == 0:
+                x2, y2 = int(rng.integers(0, width)), int(rng.integers(0, height))
+                cv2.rectangle(img, (x, y), (x2, y2), color, int(rng.integers(-1, 4)))
+            elif shape == 1:
+                r = int(rng.integers(5, min(width, height) // 4))
+                cv2.circle(img, (x, y), r, color, int(rng.integers(-1, 4)))
+            elif shape == 2:
+                x2, y2 = int(rng.integers(0, width)), int(rng.integers(0, height))
+                cv2.line(img, (x, y), (x2, y2), color, int(rng.integers(1, 4)))
+            else:
+                text = "".join(chr(c) for c in rng.integers(65, 91, 6))
+                scale = float(rng.uniform(0.5, 2))
+                cv2.putText(
+                    img, text, (x, y), cv2.FONT_HERSHEY_SIMPLEX, scale, color, 2
+                )
+        path = output / f"{i:06d}.jpg"
+        cv2.imwrite(str(path), img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        paths.append(path)
+    return paths
@@ -0,0 +1,65 @@
+import io
+import json
+import urllib.request
+from pathlib import Path
+from urllib.parse import urlencode
+
+import numpy as np
+
+from index.feature import FeatureExtractor, default_scale_factor
+from index.utils import load_image
+
+__all__ = ["extract_descriptors", "search_descriptors"]
+
+
+def extract_descriptors(
+    image: Path | str | bytes, scale_factor: float | None = None
+) -> np.ndarray:
+    """
+    使用与服务端相同的流程提取一张图片的特征点，返回 N×32 的 uint8 矩阵
+
+    图片无法读取或没有特征点时抛出 ValueError
+    """
+    img = load_image(image)
+    if img is None:
+        raise ValueError(f"无法读取图片 {image}")
+    if scale_factor is None:
+        scale_factor = default_scale_factor(img)
+    _, des = FeatureExtractor(scale_factor=scale_factor).detect_and_compute(img)
+    if len(des) == 0:
+        raise ValueError(f"无法提取特征点 {image}")
+    return des
+
+
+def search_descriptors(
+    url: str,
+    descriptors: list[np.ndarray],
+    timeout: float = 30,
+    npy: bool = False,
+    **params,
+) -> list[dict]:
+    """
+    将多张图片的特征点一次性发送到 /search/descriptors，按顺序返回每张图片的结果
+
+    params 为搜索参数，如 limit、k、nprobe 等
+    """
+    des = np.ascontiguousarray(np.concatenate(descriptors), dtype=np.uint8)
+    if npy:
+        buf = io.BytesIO()
+        np.save(buf, des)
+        body, content_type = buf.getvalue(), "application/x-npy"
+    else:
+        body, content_type = des.tobytes(), "application/octet-stream"
+
+    query = urlencode([*params.items(), *(("counts", len(d)) for d in descriptors)])
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/search/descriptors?{query}",
+        data=body,
+        headers={"Content-Type": content_type},
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as resp:
+        data = json.load(resp)
+    if "error" in data:
+        raise ValueError(data["error"])
+    return data["results"]
@@ -1,8 +1,10 @@
 from .add import add
+from .bench import bench, synthetic, tune
 from .base import cli
 from .detect import detect
 from .index import train, build
 from .match import match
 from .search import search
 from .server import server
-from .old_search import old_search
\ No newline at end of file
+from .old_search import old_search
+from .vector import vector
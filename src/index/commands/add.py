@@ -1,17 +1,29 @@
-import itertools
-import queue
-from multiprocessing import Process, Queue, Value
+import tarfile
+import zipfile
+from fnmatch import fnmatchcase
+from multiprocessing import Queue, Value, get_context
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
 from threading import Thread
 from typing import Iterator
 
 import blake3
 import click
+import numpy as np
 from loguru import logger
 from tqdm import tqdm
 
-from index.database import connect, crud
-from index.feature import FeatureExtractor
+from index.database import FlatVectorStore, FlatVectorWriter, PathTable, connect, crud
+from index.feature import FeatureExtractor, dhash, sort_by_response
+from index.index import PhashIndex
+from index.scan import (
+    ARCHIVE_PATTERNS,
+    ArchiveMember,
+    ArchiveReader,
+    ScanFile,
+    list_members,
+    scan_tree,
+)
 
 from ..utils import load_image
 from .base import cli, click_db_dir
@@ -27,112 +39,452 @@ from .base import cli, click_db_dir
     default=["*.jpg", "*.jpeg", "*.png"],
     help="匹配文件名的 glob 表达式",
 )
+@click.option(
+    "-b",
+    "--batch-size",
+    default=1000,
+    show_default=True,
+    help="每个事务写入的图片数量",
+)
+@click.option("--scan-threads", default=8, show_default=True, help="遍历目录的线程数")
+@click.option("--rescan", is_flag=True, help="忽略扫描记录，重新读取所有文件")
+@click.option(
+    "-a",
+    "--archive-glob",
+    multiple=True,
+    default=ARCHIVE_PATTERNS,
+    show_default=True,
+    help="作为压缩包读取的文件名 glob 表达式，支持 zip 和未压缩的 tar",
+)
+@click.option("--no-archive", is_flag=True, help="不读取压缩包中的图片")
+@click.option(
+    "--skip-similar",
+    type=click.IntRange(0, 7),
+    help="跳过与已导入图片的感知哈希汉明距离不超过该值的近似重复图片",
+)
 @click.argument("PATH", type=click.Path(exists=True, path_type=Path))
-def add(db_dir: Path, path: Path, glob: list[str], threads: int):
+def add(
+    db_dir: Path,
+    path: Path,
+    glob: list[str],
+    threads: int,
+    batch_size: int,
+    scan_threads: int,
+    rescan: bool,
+    archive_glob: list[str],
+    no_archive: bool,
+    skip_similar: int | None,
+):
     """
     计算并存储一个文件夹中的所有图片的特征点
+
+    压缩包中的图片直接从压缩包中读取，路径记录为 压缩包路径!文件名。
+    中断后重新运行即可继续，已写入的图片会被跳过。
+    路径、大小、修改时间和 inode 都与上次扫描相同的文件不会被读取。
+    每张图片同时记录 64 位感知哈希，指定 --skip-similar 时跳过重新编码或缩放过的近似重复图片
     """
+    # 新建数据库时表是异步创建的，不能立即查询
+    fresh = not (db_dir / "metadata.db").exists()
     connect(str(db_dir))
+    empty = np.empty(0, dtype=np.uint64)
+    known = KnownHashes(empty if fresh else crud.image.hash_prefixes())
+    scanned = empty if fresh or rescan else crud.scan.fingerprints()
+    logger.info("已导入图片：{}，已扫描文件：{}", known.size, len(scanned))
+    similar = None
+    if skip_similar is not None:
+        similar = PhashIndex(*crud.phash.load()) if not fresh else PhashIndex()
+        logger.info("已记录感知哈希：{}", len(similar))
 
-    total = sum(sum(1 for _ in path.rglob(g)) for g in glob)
-    images = itertools.chain.from_iterable(path.rglob(g) for g in glob)
+    archive_glob = [] if no_archive else list(archive_glob)
+    files = scan_tree(path, [*glob, *archive_glob], scan_threads)
 
-    input = Queue(maxsize=threads * 2)
+    input = Queue(maxsize=threads * 4)
     output = Queue()
     status = CalcStatus()
+    ring = DescriptorRing(threads * 4)
 
-    for _ in range(threads):
-        Process(target=calc_process, args=(input, output, status)).start()
+    # 感知哈希索引不能序列化，worker 通过 fork 继承，写时复制共享同一份内存
+    fork = get_context("fork")
+    workers = [
+        fork.Process(
+            target=calc_process,
+            args=(input, output, ring, known, similar, skip_similar, status),
+        )
+        for _ in range(threads)
+    ]
+    for p in workers:
+        p.start()
 
-    t1 = Thread(target=feed_thread, args=(input, images, threads))
-    t2 = Thread(target=write_thread, args=(output, threads, total))
+    t1 = Thread(
+        target=feed_thread,
+        args=(input, output, files, scanned, list(glob), archive_glob, status, threads),
+    )
+    t2 = Thread(
+        target=write_thread,
+        args=(output, ring, status, threads, db_dir, batch_size, skip_similar),
+    )
     t1.start()
     t2.start()
 
-    t2.join()
+    try:
+        t2.join()
+        for p in workers:
+            p.join()
+    finally:
+        for shm in (ring, known):
+            shm.close()
+            shm.unlink()
 
+    # 没有新图片时不必重建路径映射表
+    if status.added.value or PathTable.open(db_dir) is None:
+        logger.info("更新路径映射表：{} 条记录", PathTable.build(db_dir))
+    logger.info("未变化的文件：{}", status.unchanged.value)
+    logger.info("新增图片：{}", status.added.value)
     logger.info("总共处理图片：{}", status.total.value)
+    logger.info("已导入过图片：{}", status.skip.value)
+    logger.info("近似重复图片：{}", status.similar.value)
     logger.info("读取失败图片：{}", status.fail_read.value)
     logger.info("特征点提取失败图片：{}", status.fail_detect.value)
     logger.info("特征点数量过少图片：{}", status.fail_less.value)
+    logger.info("处理出错图片：{}", status.fail_error.value)
 
 
 class CalcStatus:
     def __init__(self) -> None:
+        self.unchanged = Value("i", 0)
+        self.added = Value("i", 0)
         self.total = Value("i", 0)
+        self.skip = Value("i", 0)
+        self.similar = Value("i", 0)
         self.fail_read = Value("i", 0)
         self.fail_detect = Value("i", 0)
         self.fail_less = Value("i", 0)
+        self.fail_error = Value("i", 0)
 
 
-class InputImage:
-    def __init__(self, path: Path):
-        self.path = path
-        self.data = path.read_bytes()
-        self.des = None
-        self._hash = None
+# 每张图片最多的特征点数量，与向量 ID 中特征点序号的 10 位一致
+MAX_FEATURES = 1 << 10
 
-    @property
-    def hash(self):
-        if self._hash is None:
-            self._hash = blake3.blake3(self.data).digest()
-        return self._hash
 
+class DescriptorRing:
+    """
+    共享内存中固定数量的特征点槽位
 
-def calc_process(input: Queue, output: Queue, status: CalcStatus):
-    ft = FeatureExtractor()
+    worker 从 free 中取得空闲槽位并写入特征点，队列中只传递槽位编号，
+    写入线程读取后再将槽位放回 free。槽位用完时 worker 阻塞，直到写入线程跟上
+    """
 
-    while True:
-        try:
-            img: InputImage | None = input.get(timeout=1)
-            if img is None:
-                break
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.shm = SharedMemory(create=True, size=slots * MAX_FEATURES * 32)
+        self.free = Queue()
+        for i in range(slots):
+            self.free.put(i)
+
+    def view(self) -> np.ndarray:
+        return np.ndarray((self.slots, MAX_FEATURES, 32), np.uint8, self.shm.buf)
+
+    def close(self):
+        self.shm.close()
 
+    def unlink(self):
+        self.shm.unlink()
+
+
+class KnownHashes:
+    """
+    已导入图片哈希的前 8 字节，排序后放在共享内存中，worker 不必查询数据库即可跳过已导入的图片
+
+    前 8 字节相同而内容不同的概率约为 已导入图片数 / 2^64，可以忽略
+    """
+
+    def __init__(self, prefixes: np.ndarray):
+        self.size = len(prefixes)
+        self.shm = SharedMemory(create=True, size=max(1, self.size) * 8)
+        self.view()[:] = prefixes
+
+    def view(self) -> np.ndarray:
+        return np.ndarray(self.size, np.uint64, self.shm.buf)
+
+    @staticmethod
+    def contains(prefixes: np.ndarray, digest: bytes) -> bool:
+        key = np.uint64(int.from_bytes(digest[:8], "little"))
+        i = np.searchsorted(prefixes, key)
+        return bool(i < len(prefixes) and prefixes[i] == key)
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+# 文件，哈希，槽位编号，特征点数量，感知哈希。槽位为 -1 表示已导入过或处理失败，
+# 哈希为 None 表示文件读取失败，下次扫描时需要重试
+Result = tuple[ScanFile | ArchiveMember, bytes | None, int, int, bytes | None]
+
+
+def calc_process(
+    input: Queue,
+    output: Queue,
+    ring: DescriptorRing,
+    known: KnownHashes,
+    similar: PhashIndex | None,
+    radius: int | None,
+    status: CalcStatus,
+):
+    """
+    读取图片、计算哈希并提取特征点，只将哈希和共享内存中的槽位编号发送给写入线程
+    """
+    ft = FeatureExtractor()
+    reader = ArchiveReader()
+    slots = ring.view()
+    prefixes = known.view()
+
+    try:
+        while (file := input.get()) is not None:
             status.total.value += 1
+            slot = -1
+            try:
+                digest, des, phash = calc_image(
+                    file, reader, ft, prefixes, similar, radius, status
+                )
+                if des is None:
+                    output.put((file, digest, -1, 0, None))
+                    continue
+                n = min(len(des), MAX_FEATURES)
+                slot = ring.free.get()
+                slots[slot, :n] = des[:n]
+                output.put((file, digest, slot, n, phash))
+            except Exception:
+                # 哈希为 None，下次运行时会重新处理这个文件
+                status.fail_error.value += 1
+                logger.exception("处理图片出错 {}", file.path)
+                if slot >= 0:
+                    ring.free.put(slot)
+                output.put((file, None, -1, 0, None))
+    finally:
+        # 写入线程等待所有 worker 发送 None 后才会结束
+        output.put(None)
+        del slots, prefixes
+        reader.close()
+        ring.close()
+        known.close()
 
-            arr = load_image(img.data)
-            if arr is None:
-                status.fail_read.value += 1
-                logger.warning("无法读取图片 {}", img.path)
-                continue
 
-            _, des = ft.detect_and_compute(arr)
-            if len(des) == 0:
-                status.fail_detect.value += 1
-                logger.warning("无法提取特征点 {}", img.path)
-                continue
-            if len(des) < 500:
-                status.fail_less.value += 1
-                logger.warning("特征点数量过少 {}", img.path)
-                continue
+def calc_image(
+    file: ScanFile | ArchiveMember,
+    reader: ArchiveReader,
+    ft: FeatureExtractor,
+    known: np.ndarray,
+    similar: PhashIndex | None,
+    radius: int | None,
+    status: CalcStatus,
+) -> tuple[bytes | None, np.ndarray | None, bytes | None]:
+    """
+    读取一张图片并计算哈希、感知哈希和特征点，图片已导入过、与已导入图片近似重复或处理失败时
+    特征点为 None，读取文件失败时哈希也为 None
+    """
+    path = file.path
+    try:
+        data = reader.read(file)
+    except OSError as e:
+        status.fail_read.value += 1
+        logger.warning("无法读取文件 {}：{}", path, e)
+        return None, None, None
+    digest = blake3.blake3(data).digest()
+    if KnownHashes.contains(known, digest):
+        status.skip.value += 1
+        return digest, None, None
 
-            img.des = des
+    arr = load_image(data)
+    if arr is None:
+        status.fail_read.value += 1
+        logger.warning("无法读取图片 {}", path)
+        return digest, None, None
 
-            output.put(img)
-        except queue.Empty:
-            continue
+    phash = dhash(arr)
+    if (
+        similar is not None
+        and phash is not None
+        and (matches := similar.search(phash, radius))
+    ):
+        status.similar.value += 1
+        logger.debug("{} 与图片 {} 近似重复，距离 {}", path, *matches[0])
+        return digest, None, None
 
-    output.put(None)
+    kps, des = ft.detect_and_compute(arr)
+    if len(des) == 0:
+        status.fail_detect.value += 1
+        logger.warning("无法提取特征点 {}", path)
+        return digest, None, None
+    if len(des) < 500:
+        status.fail_less.value += 1
+        logger.warning("特征点数量过少 {}", path)
+        return digest, None, None
+    # 按响应值排序后存储，build --max-descriptors 只需保留每张图片的前 N 个
+    return digest, sort_by_response(kps, des), phash
 
 
-def feed_thread(input: Queue, images: Iterator[Path], threads: int):
-    for image in images:
-        img = InputImage(image)
-        if crud.image.check_hash(img.hash):
+def feed_thread(
+    input: Queue,
+    output: Queue,
+    files: Iterator[ScanFile],
+    scanned: np.ndarray,
+    patterns: list[str],
+    archive_patterns: list[str],
+    status: CalcStatus,
+    threads: int,
+):
+    for file in files:
+        if KnownHashes.contains(scanned, file.fingerprint):
+            status.unchanged.value += 1
+            continue
+        name = Path(file.path).name
+        if not any(fnmatchcase(name, p) for p in archive_patterns):
+            input.put(file)
             continue
-        input.put(img)
+
+        # 压缩包中的每个文件分别交给 worker 读取，已处理过的文件同样跳过
+        try:
+            members = list_members(file, patterns)
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+            logger.warning("无法读取压缩包 {}：{}", file.path, e)
+            continue
+        pending = [
+            m for m in members if not KnownHashes.contains(scanned, m.fingerprint)
+        ]
+        status.unchanged.value += len(members) - len(pending)
+        if not pending:
+            # 没有需要处理的文件，直接交给写入线程记录压缩包本身
+            output.put((file, b"", -1, 0, None))
+        for member in pending:
+            input.put(member._replace(count=len(pending)))
     for _ in range(threads):
         input.put(None)
 
 
-def write_thread(output: Queue, threads: int, total: int):
+def write_thread(
+    output: Queue,
+    ring: DescriptorRing,
+    status: CalcStatus,
+    threads: int,
+    db_dir: Path,
+    batch_size: int,
+    radius: int | None,
+):
+    # 已导入扁平向量存储时，新的向量只追加到扁平存储中
+    writer = None
+    if FlatVectorStore.open(db_dir) is not None:
+        writer = FlatVectorWriter(db_dir)
+    next_id = rollback_uncommitted(writer) + 1
+
+    slots = ring.view()
+    # 本次添加中内容相同的图片只保留第一张
+    seen = set()
+    # 本次添加的图片的感知哈希，worker 只能检查启动前已导入的图片
+    similar = PhashIndex() if radius is not None else None
+    # 压缩包中尚未处理完的文件数量，全部处理完后才记录压缩包本身
+    remaining: dict[str, int] = {}
+    batch = Batch()
     exit_threads = 0
-    with tqdm(total=total) as bar:
+    with tqdm() as bar:
         while exit_threads != threads:
-            img: InputImage | None = output.get()
-            if img is None:
+            r: Result | None = output.get()
+            if r is None:
                 exit_threads += 1
+                continue
+            file, digest, slot, n, phash = r
+            if slot >= 0:
+                des = slots[slot, :n].copy()
+                ring.free.put(slot)
+                if digest in seen:
+                    pass
+                elif is_similar(similar, phash, radius):
+                    status.similar.value += 1
+                else:
+                    seen.add(digest)
+                    batch.images.append((next_id, digest, file.path))
+                    batch.vectors.append((next_id, des))
+                    if phash is not None:
+                        batch.phashes.append((next_id, phash))
+                        if similar is not None:
+                            similar.add(
+                                np.array([next_id]),
+                                np.frombuffer(phash, np.uint8).reshape(1, 8),
+                            )
+                    next_id += 1
+                    status.added.value += 1
+            if digest is not None:
+                batch.files.append((*file[:4], file.fingerprint))
+                if isinstance(file, ArchiveMember):
+                    archive = file.archive
+                    left = remaining.pop(archive.path, file.count) - 1
+                    if left:
+                        remaining[archive.path] = left
+                    else:
+                        batch.files.append((*archive, archive.fingerprint))
+            if len(batch.images) >= batch_size or len(batch.files) >= batch_size:
+                batch.commit(writer)
+            bar.update()
+        batch.commit(writer)
+
+    del slots
+    if writer is not None:
+        writer.close()
+
+
+def is_similar(similar: PhashIndex | None, phash: bytes | None, radius: int) -> bool:
+    """
+    图片是否与本次已添加的图片近似重复
+    """
+    if similar is None or phash is None:
+        return False
+    return bool(similar.search(phash, radius))
+
+
+def rollback_uncommitted(writer: FlatVectorWriter | None) -> int:
+    """
+    删除上次中断时已写入特征点但没有写入图片记录的向量，返回最大的图片 ID
+    """
+    committed = crud.image.max_id()
+    if writer is not None:
+        writer.truncate(committed + 1)
+    if removed := crud.vector.delete_after(committed):
+        logger.info("删除未完成的向量记录：{}", removed)
+    crud.phash.delete_after(committed)
+    return committed
+
+
+class Batch:
+    """
+    一批待写入的结果
+    """
+
+    def __init__(self):
+        self.images: list[tuple[int, bytes, str]] = []
+        self.vectors: list[tuple[int, np.ndarray]] = []
+        self.phashes: list[tuple[int, bytes]] = []
+        self.files: list[tuple[str, int, int, int, bytes]] = []
+
+    def commit(self, writer: FlatVectorWriter | None):
+        """
+        依次写入特征点、感知哈希、图片记录和扫描记录，图片记录写入后这一批图片才算完成，
+        扫描记录最后写入，中断时最多重新读取这一批文件
+        """
+        if self.vectors:
+            if writer is not None:
+                for key, des in self.vectors:
+                    writer.append(key, des)
+                writer.flush()
             else:
-                key = crud.image.create(img.hash, str(img.path))
-                crud.vector.create(key, img.des)
-                bar.update()
+                crud.vector.insert_many(self.vectors)
+            if self.phashes:
+                crud.phash.insert_many(self.phashes)
+            crud.image.insert_many(self.images)
+        if self.files:
+            crud.scan.upsert_many(self.files)
+        self.images.clear()
+        self.vectors.clear()
+        self.phashes.clear()
+        self.files.clear()
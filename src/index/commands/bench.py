@@ -0,0 +1,204 @@
+import json
+import os
+import platform
+from datetime import datetime
+from pathlib import Path
+
+import click
+import faiss
+from loguru import logger
+
+from index.bench import (
+    DISTORTIONS,
+    format_table,
+    generate_synthetic,
+    make_queries,
+    param_grid,
+    run_bench,
+    sample_images,
+)
+from index.bench import tune as tune_params
+from index.database import connect, crud
+from index.index import FaissIndexManager
+from index.index.index import read_checkpoint
+
+from .base import cli, click_db_dir
+
+
+@cli.command()
+@click_db_dir
+@click.option("-n", "--name", required=True, help="索引名称")
+@click.option("--mmap", is_flag=True, help="使用 mmap 加载索引")
+@click.option(
+    "-q", "--queries", default=100, show_default=True, help="用于查询的图片数量"
+)
+@click.option(
+    "--distortion",
+    multiple=True,
+    type=click.Choice(list(DISTORTIONS)),
+    default=list(DISTORTIONS),
+    show_default=True,
+    help="对查询图片应用的变换",
+)
+@click.option("--nprobe", multiple=True, default=[1, 2, 4, 8, 16], show_default=True)
+@click.option("-k", multiple=True, default=[3], show_default=True)
+@click.option("--max-codes", multiple=True, default=[0], show_default=True)
+@click.option("--ef-search", multiple=True, default=[16], show_default=True)
+@click.option("-l", "--limit", default=10, show_default=True, help="返回结果数量")
+@click.option("--seed", default=0, show_default=True, help="选择图片和变换的随机数种子")
+@click.option(
+    "-o", "--output", type=click.Path(path_type=Path), help="将结果保存为 JSON 文件"
+)
+def bench(
+    db_dir: Path,
+    name: str,
+    mmap: bool,
+    queries: int,
+    distortion: list[str],
+    nprobe: list[int],
+    k: list[int],
+    max_codes: list[int],
+    ef_search: list[int],
+    limit: int,
+    seed: int,
+    output: Path | None,
+):
+    """
+    使用已索引的图片及其变换测试不同搜索参数的召回率和延迟
+    """
+    connect(str(db_dir), vector=False, readonly=True)
+    m = FaissIndexManager(db_dir)
+    index = m.get_index(name, mmap)
+
+    images = sample_images(queries, indexed_max_id(m, name), seed)
+    query_set = make_queries(images, list(distortion), seed)
+    logger.info("{} 张图片，{} 个查询", len(images), len(query_set))
+    if not query_set:
+        raise click.UsageError("没有可用的查询图片")
+
+    grid = param_grid(list(nprobe), list(k), list(max_codes), list(ef_search))
+    results = run_bench(index, query_set, grid, limit)
+    click.echo(format_table(results, limit))
+
+    if output is not None:
+        output.write_text(
+            json.dumps(
+                {
+                    "index": name,
+                    "queries": len(query_set),
+                    "limit": limit,
+                    "results": [r.to_dict() for r in results],
+                },
+                indent=2,
+            )
+        )
+        logger.info("结果已保存到 {}", output)
+
+
+def indexed_max_id(m: FaissIndexManager, name: str) -> int:
+    """
+    确定已经添加到索引中的最大图片 ID，查询图片只从中选择
+    """
+    max_id = crud.image.max_id()
+    if m.get_shard_ranges(name) is None:
+        last_id = read_checkpoint(m.get_index_path(name))
+        max_id = max_id if last_id is None else min(max_id, last_id)
+    return max_id
+
+
+@cli.command()
+@click.option("-n", "--num", default=100, show_default=True, help="生成的图片数量")
+@click.option("--seed", default=0, show_default=True, help="随机数种子")
+@click.argument("OUTPUT", type=click.Path(path_type=Path))
+def synthetic(output: Path, num: int, seed: int):
+    """
+    生成随机图片，用于在没有真实数据时测试添加、构建、搜索和 bench
+    """
+    paths = generate_synthetic(output, num, seed=seed)
+    logger.info("已生成 {} 张图片到 {}", len(paths), output)
+
+
+@cli.command()
+@click_db_dir
+@click.option("-n", "--name", required=True, help="索引名称")
+@click.option("--mmap", is_flag=True, help="使用 mmap 加载索引")
+@click.option("--target-recall", type=float, help="要求达到的 recall@1")
+@click.option("--latency-budget", type=float, help="允许的 p95 延迟，单位毫秒")
+@click.option(
+    "-q", "--queries", default=100, show_default=True, help="用于查询的图片数量"
+)
+@click.option(
+    "--nprobe",
+    multiple=True,
+    default=[1, 2, 4, 8, 16, 32, 64],
+    show_default=True,
+)
+@click.option("-k", multiple=True, default=[1, 2, 3, 5, 8], show_default=True)
+@click.option("--max-codes", multiple=True, default=[0], show_default=True)
+@click.option("--ef-search", multiple=True, default=[16, 32, 64], show_default=True)
+@click.option("-l", "--limit", default=10, show_default=True, help="返回结果数量")
+@click.option("--seed", default=0, show_default=True, help="选择图片和变换的随机数种子")
+def tune(
+    db_dir: Path,
+    name: str,
+    mmap: bool,
+    target_recall: float | None,
+    latency_budget: float | None,
+    queries: int,
+    nprobe: list[int],
+    k: list[int],
+    max_codes: list[int],
+    ef_search: list[int],
+    limit: int,
+    seed: int,
+):
+    """
+    为索引寻找满足召回率或延迟目标的最优搜索参数，保存后 search 和 server 默认使用
+    """
+    if target_recall is None and latency_budget is None:
+        raise click.UsageError("需要指定 --target-recall 或 --latency-budget")
+
+    connect(str(db_dir), vector=False, readonly=True)
+    m = FaissIndexManager(db_dir)
+    index = m.get_index(name, mmap)
+    query_set = make_queries(
+        sample_images(queries, indexed_max_id(m, name), seed), list(DISTORTIONS), seed
+    )
+    logger.info("{} 个查询", len(query_set))
+    if not query_set:
+        raise click.UsageError("没有可用的查询图片")
+
+    grid = param_grid(list(nprobe), list(k), list(max_codes), list(ef_search))
+    best, front = tune_params(
+        index, query_set, grid, limit, target_recall, latency_budget
+    )
+    click.echo(format_table(front, limit))
+    if best is None:
+        raise click.ClickException("没有满足目标的搜索参数")
+
+    path = m.get_params_path(name)
+    path.write_text(
+        json.dumps(
+            {
+                "params": best.params,
+                "target_recall": target_recall,
+                "latency_budget": latency_budget,
+                "queries": len(query_set),
+                "machine": {
+                    "host": platform.node(),
+                    "cpus": os.cpu_count(),
+                    "omp_threads": faiss.omp_get_max_threads(),
+                },
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "pareto": [r.to_dict() for r in front],
+            },
+            indent=2,
+        )
+    )
+    logger.info(
+        "最优参数 {}：R@1 {:.3f}，p95 {:.2f} ms，已保存到 {}",
+        best.params,
+        best.recall_at_1,
+        best.p95,
+        path,
+    )
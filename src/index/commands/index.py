@@ -1,14 +1,20 @@
-import threading
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from queue import Queue
 
 import click
+import faiss
 import numpy as np
 from loguru import logger
+from tqdm import tqdm
 
-from index.database import connect, crud
-from index.index import FaissIndexManager, FaissIndexTrainer
+from index.database import FlatVectorStore, VectorReader, connect, crud
+from index.index import FaissIndex, FaissIndexManager, FaissIndexTrainer
+from index.index.delta import delta_path
+from index.index.index import read_checkpoint, write_checkpoint
+from index.index.ondisk import is_ondisk, merge_ondisk
 
 from .base import cli, click_db_dir
 
@@ -16,14 +22,42 @@ from .base import cli, click_db_dir
 # TODO: chunk 的默认值是否应该能被 cpu 数量整除？
 @cli.command()
 @click_db_dir
-@click.option("-l", "--limit", help="限制添加的图片数量")
+@click.option("-l", "--limit", type=int, help="限制添加的图片数量")
 @click.option(
     "-c", "--chunk", default=50000, show_default=True, help="每批添加多少张图片到索引中"
 )
 @click.option("-n", "--name", help="索引名称", required=True)
 @click.option("-d", "--description", help="索引描述", required=True)
 @click.option(
-    "-i", "--interval", default=300, show_default=True, help="保存索引的间隔，单位秒"
+    "-i",
+    "--interval",
+    default=300,
+    show_default=True,
+    help="保存增量快照的间隔，单位秒",
+)
+@click.option(
+    "--shards", type=int, help="创建分片索引，按图片 ID 范围划分为指定数量的分片"
+)
+@click.option("--shard", type=int, help="只构建分片索引中的指定分片")
+@click.option("--rebuild", is_flag=True, help="丢弃已有的索引（或分片）并重新构建")
+@click.option(
+    "-p",
+    "--parallel",
+    type=int,
+    help="使用多个进程分别构建部分索引，再合并为倒排表存储在磁盘上的索引",
+)
+@click.option(
+    "--slice",
+    "slice_size",
+    default=200000,
+    show_default=True,
+    help="并行构建时每个部分索引包含的图片 ID 数量",
+)
+@click.option("--prefetch", default=2, show_default=True, help="后台预先读取的批次数量")
+@click.option(
+    "--max-descriptors",
+    type=click.IntRange(1, 1024),
+    help="每张图片最多添加响应值最大的多少个特征点，之后继续构建时沿用",
 )
 def build(
     db_dir: Path,
@@ -32,62 +66,274 @@ def build(
     description: str,
     name: str,
     interval: int,
+    shards: int | None,
+    shard: int | None,
+    rebuild: bool,
+    parallel: int | None,
+    slice_size: int,
+    prefetch: int,
+    max_descriptors: int | None,
 ):
     """
     构建索引
     """
+    if parallel and limit:
+        raise click.BadParameter("不能与 --parallel 同时使用", param_hint="--limit")
+
     connect(str(db_dir))
     m = FaissIndexManager(db_dir, description)
-    index = m.get_index(name)
 
-    id_start = crud.image.get_indexed(name) + 1
-    logger.info("开始添加图片到索引，起始 ID: {}", id_start)
+    if shards:
+        m.create_shards(name, shards, crud.image.max_id())
+        logger.info("创建分片索引 {}：{}", name, m.get_shard_ranges(name))
+
+    # (分片编号, 图片 ID 范围)
+    ranges = m.get_shard_ranges(name)
+    if ranges is None:
+        if shard is not None:
+            raise click.BadParameter(f"索引 {name} 不是分片索引", param_hint="--shard")
+        targets = [(None, (1, None))]
+    else:
+        shard_ids = range(len(ranges)) if shard is None else [shard]
+        targets = [(i, ranges[i]) for i in shard_ids]
+
+    if not parallel and not rebuild:
+        # 直接添加会原地修改正在被搜索进程 mmap 的 .ivfdata 文件，检查点也不再可靠
+        for i, _ in targets:
+            index_path = m.find_index_path(name, i)
+            if index_path is not None and is_ondisk(index_path):
+                raise click.UsageError(
+                    f"索引 {index_path.name} 的倒排表存储在磁盘上，"
+                    "只能使用 --parallel 继续构建或使用 --rebuild 重新构建"
+                )
+
+    max_descriptors = resolve_budget(
+        m, name, max_descriptors, rebuild and shard is None
+    )
+    if max_descriptors is not None:
+        logger.info("每张图片最多添加 {} 个特征点", max_descriptors)
+
+    for i, (start, end) in targets:
+        status_name = name if i is None else f"{name}.shard{i}"
+        if rebuild:
+            m.reset_index(name, i)
+            crud.image.reset_indexed(status_name)
+        if i is not None:
+            logger.info("构建分片 {}，图片 ID 范围：[{}, {})", i, start, end or "∞")
+
+        if parallel:
+            build_parallel(
+                m,
+                m.get_index_path(name, i),
+                status_name,
+                start,
+                end,
+                chunk,
+                parallel,
+                slice_size,
+                max_descriptors,
+            )
+        else:
+            index = m.get_shard(name, i) if i is not None else m.get_index(name)
+            build_index(
+                index,
+                status_name,
+                start,
+                end,
+                limit,
+                chunk,
+                interval,
+                prefetch,
+                FlatVectorStore.open(db_dir),
+                max_descriptors,
+            )
+
+
+def resolve_budget(
+    m: FaissIndexManager, name: str, max_descriptors: int | None, rebuild: bool
+) -> int | None:
+    """
+    确定每张图片最多添加的特征点数量，未指定时沿用索引记录的值
+
+    同一个索引中的图片必须使用相同的数量，已有图片的索引修改该值时需要整体重建
+    """
+    stored = m.get_max_descriptors(name)
+    if max_descriptors is None or max_descriptors == stored:
+        return stored
+    ranges = m.get_shard_ranges(name)
+    shards = [None] if ranges is None else list(range(len(ranges)))
+    # 只检查已有的索引文件，不能在这里从训练文件创建
+    built = any(
+        (
+            (path := m.find_index_path(name, i)) is not None
+            and read_checkpoint(path) is not None
+        )
+        or crud.image.get_indexed(name if i is None else f"{name}.shard{i}")
+        for i in shards
+    )
+    if built and not rebuild:
+        raise click.BadParameter(
+            f"索引 {name} 已按 {stored or '全部'} 个特征点构建，修改需要使用 --rebuild 重建整个索引",
+            param_hint="--max-descriptors",
+        )
+    m.set_max_descriptors(name, max_descriptors)
+    return max_descriptors
+
+
+def build_parallel(
+    m: FaissIndexManager,
+    index_path: Path,
+    status_name: str,
+    start: int,
+    end: int | None,
+    chunk: int,
+    parallel: int,
+    slice_size: int,
+    max_descriptors: int | None = None,
+):
+    """
+    将 [start, end) 范围内尚未索引的图片按 ID 切片，由多个进程分别构建部分索引，
+    然后与已有的索引一起合并为倒排表存储在磁盘上的索引
+    """
+    if delta_path(index_path).exists():
+        # 增量快照需要加载索引重放后才能合并，只有此前的普通构建中断时才会出现
+        id_start = resume_start(FaissIndex(str(index_path)), status_name, start)
+    elif (last_id := read_checkpoint(index_path)) is not None:
+        id_start = max(start, last_id + 1)
+    else:
+        id_start = start + crud.image.get_indexed(status_name)
+    id_end = end or crud.image.max_id() + 1
+    slices = [
+        (s, min(s + slice_size, id_end)) for s in range(id_start, id_end, slice_size)
+    ]
+    if not slices:
+        logger.info("没有需要添加的图片")
+        return
+    logger.info("开始并行构建，起始 ID: {}，共 {} 个部分", id_start, len(slices))
+
+    parts = [
+        index_path.with_name(f"{index_path.name}.part{j}") for j in range(len(slices))
+    ]
+    omp_threads = max(1, (os.cpu_count() or 1) // parallel)
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(parallel, mp_context=ctx) as executor:
+        futures = [
+            executor.submit(
+                build_partial,
+                m.db_dir,
+                m.train_path,
+                part,
+                s,
+                e,
+                chunk,
+                omp_threads,
+                max_descriptors,
+            )
+            for part, (s, e) in zip(parts, slices)
+        ]
+        added = 0
+        for future in tqdm(futures):
+            added += future.result()
+
+    merge_ondisk(m.train_path, [index_path, *parts], index_path)
+    write_checkpoint(index_path, id_end - 1)
+    crud.image.add_indexed(status_name, added)
+    for part in parts:
+        part.unlink()
 
-    queue = Queue(1)
-    start = datetime.now()
 
-    chunk_thread = threading.Thread(
-        target=chunk_index, args=(id_start, limit, chunk, queue)
+def build_partial(
+    db_dir: Path,
+    train_path: Path,
+    part_path: Path,
+    start: int,
+    end: int,
+    chunk: int,
+    omp_threads: int,
+    max_descriptors: int | None = None,
+) -> int:
+    """
+    在子进程中将 [start, end) 的图片添加到一个新的部分索引中，返回添加的图片数量
+    """
+    faiss.omp_set_num_threads(omp_threads)
+    connect(str(db_dir), metadata=False, readonly=True)
+    index = FaissIndex(str(train_path))
+
+    reader = VectorReader(
+        start,
+        end,
+        None,
+        chunk,
+        store=FlatVectorStore.open(db_dir),
+        max_descriptors=max_descriptors,
     )
-    chunk_thread.start()
+    added = 0
+    for r in reader:
+        index.add_with_ids(r.vectors, r.xids)
+        added += r.count
 
-    while True:
-        r = queue.get()
-        if r is None:
-            break
+    index.path = str(part_path)
+    index.save()
+    return added
 
-        ilist, vlist = r
-        logger.info("正在增加 {} 张图片", len(vlist))
-        xids = np.concatenate(ilist)
-        vectors = np.concatenate(vlist)
-        index.add_with_ids(vectors, xids)
 
-        if (datetime.now() - start).seconds > interval:
+def build_index(
+    index: FaissIndex,
+    status_name: str,
+    start: int,
+    end: int | None,
+    limit: int | None,
+    chunk: int,
+    interval: int,
+    prefetch: int,
+    store: FlatVectorStore | None = None,
+    max_descriptors: int | None = None,
+):
+    """
+    将 [start, end) 范围内尚未索引的图片添加到索引中
+    """
+    id_start = resume_start(index, status_name, start)
+    logger.info("开始添加图片到索引，起始 ID: {}", id_start)
+    # 增量快照中的记录需要检查点才能在中断后恢复
+    write_checkpoint(Path(index.path), id_start - 1)
+    index.enable_delta()
+
+    reader = VectorReader(id_start, end, limit, chunk, prefetch, store, max_descriptors)
+    last_save = datetime.now()
+    # 上次保存后新增的图片数量和最后一张图片 ID
+    pending = 0
+    last_id = None
+
+    for r in reader:
+        logger.info("正在增加 {} 张图片", r.count)
+        index.add_with_ids(r.vectors, r.xids)
+        pending += r.count
+        last_id = r.last_id
+
+        if (datetime.now() - last_save).seconds > interval:
             logger.info("不平衡度: {}", index.imbalance())
-            logger.info("保存索引")
-            index.save()
-            crud.image.add_indexed(name, len(vlist))
-            start = datetime.now()
-            vlist = []
-
-    if vlist:
-        index.save()
-        crud.image.add_indexed(name, len(vlist))
-
-
-def chunk_index(start: int, limit: int | None, chunk_size: int, queue: Queue):
-    xids = []
-    vectors = []
-    for v in crud.vector.iter_by(start, limit):
-        xids.append(v.id << 10 | np.arange(v.vector.shape[0], dtype=np.uint64))
-        vectors.append(v.vector)
-        if len(vectors) == chunk_size:
-            queue.put((xids, vectors))
-            xids = []
-            vectors = []
-    if vectors:
-        queue.put((xids, vectors))
-    queue.put(None)
+            logger.info("保存增量快照")
+            index.snapshot(last_id)
+            crud.image.add_indexed(status_name, pending)
+            last_save = datetime.now()
+            pending = 0
+
+    logger.info("合并增量快照")
+    if pending:
+        index.snapshot(last_id)
+        crud.image.add_indexed(status_name, pending)
+    index.disable_delta()
+
+
+def resume_start(index: FaissIndex, status_name: str, start: int) -> int:
+    """
+    返回继续构建的起始图片 ID
+
+    有检查点时从检查点之后继续，否则按已索引的图片数量推算（要求图片 ID 连续）
+    """
+    if (last_id := index.resume()) is not None:
+        return max(start, last_id + 1)
+    return start + crud.image.get_indexed(status_name)
 
 
 @cli.command()
@@ -104,25 +350,80 @@ def chunk_index(start: int, limit: int | None, chunk_size: int, queue: Queue):
     "-x", default=50, show_default=True, help="使用多少倍的特征点训练索引，推荐 30~256"
 )
 @click.option("--gpu", is_flag=True, help="使用 GPU 训练索引")
+@click.option(
+    "--per-image",
+    default=100,
+    show_default=True,
+    help="每张图片最多随机采样多少个特征点，0 表示使用全部特征点",
+)
+@click.option("--seed", type=int, help="采样使用的随机数种子")
+@click.option("-t", "--threads", default=4, show_default=True, help="并行读取的线程数")
+@click.option(
+    "--hierarchical",
+    is_flag=True,
+    help="使用两级 k-means 在 CPU 上训练，适合聚类中心数量较多的索引，中断后可以继续",
+)
+@click.option(
+    "--holdout",
+    default=0.05,
+    show_default=True,
+    help="额外采样的不参与训练的向量比例，用于评估聚类中心",
+)
 def train(
     db_dir: Path,
     image_num: int,
     x: int,
     gpu: bool,
     description: str | None,
+    per_image: int,
+    seed: int | None,
+    threads: int,
+    hierarchical: bool,
+    holdout: float,
 ):
     """
     构建索引
     """
+    if gpu and hierarchical:
+        raise click.BadParameter("不能与 --gpu 同时使用", param_hint="--hierarchical")
+
     connect(str(db_dir))
     max_size = image_num * 500
     trainer = FaissIndexTrainer(db_dir, max_size, description)
     logger.info("创建索引 {}", trainer.description)
-    vectors = crud.vector.sample(x * trainer.k // 500)
-    logger.info("采样 {}/{} 向量，开始训练", len(vectors), x * trainer.k)
+
+    sample_path = trainer.checkpoint_dir / "sample.npy"
+    if hierarchical and sample_path.exists():
+        vectors = np.load(sample_path)
+        logger.info("从检查点恢复 {} 个采样向量", len(vectors))
+    else:
+        sample = (FlatVectorStore.open(db_dir) or crud.vector).sample
+        total = round(x * trainer.k * (1 + holdout))
+        vectors = sample(total, per_image or None, seed, threads)
+        logger.info("采样 {}/{} 向量", len(vectors), total)
+        if hierarchical:
+            trainer.checkpoint_dir.mkdir(exist_ok=True)
+            np.save(sample_path, vectors)
+
+    # 最后一部分向量不参与训练，用于评估聚类中心
+    split = round(len(vectors) / (1 + holdout))
+    vectors, held = vectors[:split], vectors[split:]
+    logger.info("使用 {} 个向量开始训练", len(vectors))
     if gpu:
         trainer.train_gpu(vectors)
+    elif hierarchical:
+        trainer.train_hierarchical(vectors, seed=1234 if seed is None else seed)
     else:
         trainer.train(vectors)
     logger.info("训练完成")
+
+    if len(held):
+        report = trainer.evaluate(held)
+        logger.info(
+            "留出的 {} 个向量：不平衡度 {:.3f}，空倒排表 {:.2%}，最长倒排表 {}",
+            len(held),
+            report["imbalance"],
+            report["empty"],
+            report["max"],
+        )
     trainer.save()
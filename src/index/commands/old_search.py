@@ -37,6 +37,7 @@ def old_search(db_dir: Path, image: str, limit: int, mmap: bool):
         if k != "result":
             logger.info("{}: {}", k, v)
 
+
 class ImageDB:
     def __init__(self, db_dir: Path):
         self.db = Rdict(str(db_dir / "database"))
@@ -44,16 +45,18 @@ class ImageDB:
     def find_image_path(self, feature_id: int) -> str:
         """根据特征ID查找图像路径"""
         # 先查找对应的图像ID
-        image_id_bytes = self.db.get(f"id_to_image_id:{feature_id.to_bytes(8, 'little')}")
+        image_id_bytes = self.db.get(
+            f"id_to_image_id:{feature_id.to_bytes(8, 'little')}"
+        )
         if image_id_bytes is None:
             return None
-        
+
         # 将图像ID转换为整数
-        image_id = int.from_bytes(image_id_bytes, byteorder='little', signed=True)
-        
+        image_id = int.from_bytes(image_id_bytes, byteorder="little", signed=True)
+
         # 根据图像ID查找图像路径
         path_bytes = self.db.get(f"id_to_image:{image_id.to_bytes(4, 'little')}")
         if path_bytes is None:
             return None
-        
-        return path_bytes.decode('utf-8')
\ No newline at end of file
+
+        return path_bytes.decode("utf-8")
@@ -4,7 +4,7 @@ from pathlib import Path
 import click
 from loguru import logger
 
-from index.database import connect, crud
+from index.database import PathTable, connect, crud
 from index.feature import FeatureExtractor
 from index.index import FaissIndexManager
 from index.utils import load_image
@@ -17,8 +17,24 @@ from .base import cli, click_db_dir
 @click.option("-l", "--limit", default=10, show_default=True, help="返回结果数量")
 @click.option("-n", "--name", required=True, help="索引文件名称")
 @click.option("--mmap", is_flag=True, help="使用 mmap 加载索引")
+@click.option("--max-distance", type=int, help="丢弃汉明距离大于该值的匹配")
+@click.option("-k", type=int, help="每个特征点搜索的近邻数量，默认使用调优结果")
+@click.option("--nprobe", type=int, help="搜索的倒排表数量，默认使用调优结果")
+@click.option("--max-codes", type=int, help="最多计算距离的次数，默认使用调优结果")
+@click.option("--ef-search", type=int, help="HNSW 量化器的 efSearch，默认使用调优结果")
 @click.argument("image", type=click.Path(exists=True))
-def search(db_dir: Path, image: str, name: str, limit: int, mmap: bool):
+def search(
+    db_dir: Path,
+    image: str,
+    name: str,
+    limit: int,
+    mmap: bool,
+    max_distance: int | None,
+    k: int | None,
+    nprobe: int | None,
+    max_codes: int | None,
+    ef_search: int | None,
+):
     """
     搜索图片
     """
@@ -30,13 +46,30 @@ def search(db_dir: Path, image: str, name: str, limit: int, mmap: bool):
     img = load_image(image)
     _, desc = FeatureExtractor().detect_and_compute(img)
 
-    result = index.search(desc, limit)
+    params = m.get_search_params(name)
+    for key, value in [
+        ("k", k),
+        ("nprobe", nprobe),
+        ("max_codes", max_codes),
+        ("efSearch", ef_search),
+    ]:
+        if value is not None:
+            params[key] = value
+    logger.debug("搜索参数：{}", params)
+
+    result = index.search(desc, limit, max_distance=max_distance, **params)
     for k, v in result.__dict__.items():
         if k != "result":
             logger.debug("{}: {}", k, v)
 
     now = datetime.now()
-    images = [(score, crud.image.get_by_id(id_).path) for id_, score in result.result]
+    ids = [id_ for id_, _ in result.result]
+    if table := PathTable.open(db_dir):
+        paths = table.lookup(ids)
+    else:
+        found = crud.image.get_paths(ids)
+        paths = [found[id_] for id_ in ids]
+    images = [(score, path) for (_, score), path in zip(result.result, paths)]
     logger.debug("db_time: {}", (datetime.now() - now).total_seconds() * 100)
 
     for score, path in images:
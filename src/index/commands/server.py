@@ -1,67 +1,457 @@
+import asyncio
+import contextlib
+import io
+import os
+import signal
+import socket
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Annotated
+from time import perf_counter
+from typing import Annotated, Callable
 
+import blake3
 import click
+import faiss
+import numpy as np
 import uvicorn
-from fastapi import FastAPI, File, Form, UploadFile
+from fastapi import FastAPI, File, Form, Query, Request, Response, UploadFile
+from fastapi.responses import PlainTextResponse
 from loguru import logger
 
-from index.database import connect, crud
-from index.feature import FeatureExtractor
-from index.index import FaissIndexManager
-from index.utils import load_image
+from index.database import PathTable, connect, crud
+from index.feature import FeatureExtractorPool, default_scale_factor, dhash
+from index.index import BatchSearcher, FaissIndexManager, PhashIndex
+from index.index.index import DEFAULT_SEARCH_PARAMS, FaissSearchResult
+from index.metrics import Metrics, StageTimer
+from index.utils import LRUCache, load_image, memory_usage
 
 from .base import cli, click_db_dir
 
 app = FastAPI()
-index = None
+searcher: BatchSearcher | None = None
+extract_executor: Executor | None = None
+path_table: PathTable | None = None
+result_cache: LRUCache[tuple, tuple[FaissSearchResult, float]] = LRUCache(0)
+extractors = FeatureExtractorPool()
+# 请求未指定时使用的搜索参数，启动时从索引的调优结果中读取
+search_params = dict(DEFAULT_SEARCH_PARAMS)
+metrics = Metrics()
+# 已提交到 extract_executor 但尚未完成的图片数量
+extract_inflight = 0
+# 已导入图片的感知哈希，请求未指定时使用的汉明距离半径，-1 为不使用
+phash_index: PhashIndex | None = None
+default_phash_radius = 3
+
+
+def extract_features(
+    data: bytes, orb_scale_factor: float | None, radius: int, limit: int
+) -> tuple[np.ndarray | None, float | None, list[tuple[int, int]], dict[str, float]]:
+    """
+    解码图片并提取特征点，在线程池或进程池中执行，同时返回各阶段的耗时
+
+    感知哈希在半径 radius 内找到已导入的图片时不再提取特征点，
+    返回距离最近的 limit 张图片 [(图片 ID, 距离)]
+    """
+    t0 = perf_counter()
+    img = load_image(data)
+    t1 = perf_counter()
+    timings = {"decode": (t1 - t0) * 1000}
+    if img is None:
+        return None, orb_scale_factor, [], timings
+
+    # 进程池中的 phash_index 是 fork 时继承的
+    if phash_index is not None and radius >= 0 and (code := dhash(img)) is not None:
+        near = phash_index.search(code, radius, limit)
+        t2 = perf_counter()
+        timings["phash"] = (t2 - t1) * 1000
+        t1 = t2
+        if near:
+            return None, orb_scale_factor, near, timings
+
+    if orb_scale_factor is None:
+        orb_scale_factor = default_scale_factor(img)
+
+    with extractors.get(orb_scale_factor) as ft:
+        _, des = ft.detect_and_compute(img)
+    timings["extract"] = (perf_counter() - t1) * 1000
+    return des, orb_scale_factor, [], timings
+
+
+async def run_extract(
+    data: bytes,
+    orb_scale_factor: float | None,
+    radius: int,
+    limit: int,
+    timer: StageTimer,
+) -> tuple[np.ndarray | None, float | None, list[tuple[int, int]]]:
+    """
+    在 extract_executor 中提取特征点，并记录排队等待的时间
+    """
+    global extract_inflight
+    loop = asyncio.get_running_loop()
+    t0 = perf_counter()
+    extract_inflight += 1
+    try:
+        des, orb_scale_factor, near, timings = await loop.run_in_executor(
+            extract_executor, extract_features, data, orb_scale_factor, radius, limit
+        )
+    finally:
+        extract_inflight -= 1
+    elapsed = (perf_counter() - t0) * 1000
+    timer.add("extract_wait", max(0.0, elapsed - sum(timings.values())))
+    for stage, ms in timings.items():
+        timer.add(stage, ms)
+    return des, orb_scale_factor, near
+
+
+def normalize_scale_factor(orb_scale_factor: float | None) -> float | None:
+    """
+    检查请求中的 ORB 金字塔缩放系数并按 0.05 取整，超出 [0.5, 2.0] 时抛出 ValueError
+    """
+    if orb_scale_factor is None:
+        return None
+    if not 0.5 <= orb_scale_factor <= 2.0:
+        raise ValueError("orb_scale_factor 需要在 0.5 到 2.0 之间")
+    return round(round(orb_scale_factor / 0.05) * 0.05, 2)
+
+
+def phash_score(distance: int) -> float:
+    """
+    感知哈希命中的得分，按汉明距离从 100 线性递减。距离为 0 时同样是 100，
+    与内容完全相同的图片只能通过 meta 中的 exact_match 和 phash_distance 区分
+    """
+    return round(100.0 * (64 - distance) / 64, 2)
+
+
+def resolve_params(
+    k: int | None, nprobe: int | None, max_codes: int | None, ef_search: int | None
+) -> tuple[int, int, int, int]:
+    """
+    用默认搜索参数补全请求中未指定的参数
+    """
+    return (
+        search_params["k"] if k is None else k,
+        search_params["nprobe"] if nprobe is None else nprobe,
+        search_params["max_codes"] if max_codes is None else max_codes,
+        search_params["efSearch"] if ef_search is None else ef_search,
+    )
+
+
+def find_by_hash(data: bytes) -> tuple[bytes, int | None]:
+    """
+    计算上传文件的哈希，并查找完全相同的已导入图片
+    """
+    digest = blake3.blake3(data).digest()
+    image = crud.image.get_by_hash(digest)
+    return digest, image.id if image else None
+
+
+def get_paths(ids: list[int]) -> list[str]:
+    if path_table is not None:
+        return path_table.lookup(ids)
+    paths = crud.image.get_paths(ids)
+    return [paths[id_] for id_ in ids]
+
+
+def parse_descriptors(body: bytes, content_type: str) -> np.ndarray:
+    """
+    解析 N×32 的 uint8 特征点矩阵，支持原始字节和 npy 格式
+    """
+    if content_type in ("application/x-npy", "application/npy"):
+        des = np.load(io.BytesIO(body), allow_pickle=False)
+        if des.dtype != np.uint8 or des.ndim != 2 or des.shape[1] != 32:
+            raise ValueError(f"特征点矩阵格式错误：{des.dtype} {des.shape}")
+        return des
+    if len(body) % 32 != 0:
+        raise ValueError("特征点数据长度不是 32 的倍数")
+    return np.frombuffer(body, dtype=np.uint8).reshape(-1, 32)
+
+
+def result_meta(result: FaissSearchResult) -> dict:
+    return {
+        "nq": result.nq,
+        "nlist": result.nlist,
+        "ndis": result.ndis,
+        "quantization_time": round(result.quantization_time, 2),
+        "search_time": round(result.search_time, 2),
+        "batch_size": result.batch_size,
+    }
+
+
+def result_timings(result: FaissSearchResult) -> dict[str, float]:
+    """
+    一次搜索在 BatchSearcher 中各阶段的耗时，quantize 和 scan 为整个批次的耗时
+    """
+    return {
+        "queue": result.queue_time,
+        "quantize": result.quantization_time,
+        "scan": result.search_time,
+        "aggregate": result.aggregate_time,
+    }
+
+
+async def render_result(result: FaissSearchResult) -> list[tuple[float, str]]:
+    paths = await asyncio.to_thread(get_paths, [id_ for id_, _ in result.result])
+    return [(score, path) for (_, score), path in zip(result.result, paths)]
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "cache": {
+            "size": len(result_cache),
+            "maxsize": result_cache.maxsize,
+            "hits": result_cache.hits,
+            "misses": result_cache.misses,
+        },
+        "memory": memory_usage(),
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Prometheus 格式的监控指标，多 worker 时只包含处理本次请求的 worker
+    """
+    assert searcher is not None
+    index = searcher.index
+    sizes, imbalance = await asyncio.to_thread(
+        lambda: (index.list_sizes, index.imbalance())
+    )
+    gauges = [
+        ("batch_queue_depth", {}, searcher.queue_depth),
+        ("batch_running", {}, searcher.running),
+        ("extract_inflight", {}, extract_inflight),
+        ("cache_size", {}, len(result_cache)),
+        (
+            "cache_hit_ratio",
+            {},
+            result_cache.hits / max(1, result_cache.hits + result_cache.misses),
+        ),
+        ("ntotal", {}, int(sizes.sum())),
+        ("nlist", {}, len(sizes)),
+        ("imbalance", {}, imbalance),
+        ("empty_lists", {}, int(np.sum(sizes == 0))),
+        ("phash_ntotal", {}, len(phash_index) if phash_index is not None else 0),
+    ]
+    quantiles = [0, 0.5, 0.9, 0.99, 0.999, 1]
+    for q, v in zip(quantiles, np.quantile(sizes, quantiles)):
+        gauges.append(("list_size", {"quantile": str(q)}, float(v)))
+    for kind, v in (memory_usage() or {}).items():
+        gauges.append(("memory_bytes", {"kind": kind}, v))
+    counters = [
+        ("cache_hits_total", {}, result_cache.hits),
+        ("cache_misses_total", {}, result_cache.misses),
+    ]
+    return PlainTextResponse(
+        metrics.render(gauges, counters), media_type="text/plain; version=0.0.4"
+    )
 
 
 @app.post("/search")
 async def search(
+    response: Response,
     file: Annotated[bytes, File()],
     limit: int = 5,
-    k: int = 3,
-    nprobe: int = 4,
-    max_codes: int = 0,
+    k: int | None = None,
+    nprobe: int | None = None,
+    max_codes: int | None = None,
+    ef_search: int | None = None,
+    max_distance: int | None = None,
     orb_scale_factor: float | None = None,
+    phash_radius: int | None = None,
 ):
-    img = load_image(file)
-    if img is None:
-        return {"error": "图片读取失败"}
-
-    if orb_scale_factor is None:
-        if img.shape[1] <= 400:
-            orb_scale_factor = 0.9
-        else:
-            orb_scale_factor = 1.2
+    """
+    上传图片搜索，依次查找内容完全相同、感知哈希相近的已导入图片，都没有时才提取特征点搜索
+    """
+    assert searcher is not None
 
-    ft = FeatureExtractor(scale_factor=orb_scale_factor)
-    _, des = ft.detect_and_compute(img)
+    timer = StageTimer()
+    k, nprobe, max_codes, ef_search = resolve_params(k, nprobe, max_codes, ef_search)
+    try:
+        orb_scale_factor = normalize_scale_factor(orb_scale_factor)
+    except ValueError as e:
+        metrics.inc("search_requests_total", outcome="error")
+        return {"error": str(e)}
+    if phash_radius is None:
+        phash_radius = default_phash_radius
+    if phash_index is not None and phash_radius > phash_index.max_radius:
+        metrics.inc("search_requests_total", outcome="error")
+        return {"error": f"phash_radius 不能超过 {phash_index.max_radius}"}
+    params = (
+        limit,
+        k,
+        nprobe,
+        max_codes,
+        ef_search,
+        max_distance,
+        orb_scale_factor,
+        phash_radius,
+    )
+    with timer.stage("hash"):
+        digest, image_id = await asyncio.to_thread(find_by_hash, file)
+    exact_match = image_id is not None
+    cached = None if exact_match else result_cache.get((digest, *params))
+    near: list[tuple[int, int]] = []
 
-    assert index is not None
+    if exact_match:
+        # 上传的图片已经导入过，直接返回该图片
+        outcome = "exact"
+        result = FaissSearchResult(
+            nq=0,
+            nlist=0,
+            ndis=0,
+            quantization_time=0.0,
+            search_time=0.0,
+            result=[(image_id, 100.0)],
+            # 没有经过 BatchSearcher
+            batch_size=0,
+        )
+    elif cached is not None:
+        outcome = "cache"
+        result, orb_scale_factor = cached
+    else:
+        des, orb_scale_factor, near = await run_extract(
+            file, orb_scale_factor, phash_radius, limit, timer
+        )
+        if near:
+            # 重新编码或缩放过的已导入图片，直接返回感知哈希最接近的几张图片
+            outcome = "phash"
+            result = FaissSearchResult(
+                nq=0,
+                nlist=0,
+                ndis=0,
+                quantization_time=0.0,
+                search_time=0.0,
+                result=[(id_, phash_score(d)) for id_, d in near],
+                batch_size=0,
+            )
+        elif des is None or len(des) == 0:
+            metrics.inc("search_requests_total", outcome="error")
+            return {"error": "图片读取失败" if des is None else "无法提取特征点"}
+        else:
+            outcome = "search"
+            result = await searcher.search(
+                des, limit, k, nprobe, max_codes, ef_search, max_distance
+            )
+            result_cache.put((digest, *params), (result, orb_scale_factor))
+            for stage, ms in result_timings(result).items():
+                timer.add(stage, ms)
 
-    result = index.search(des, limit, k, nprobe, max_codes)
-    images = [(score, crud.image.get_by_id(id_).path) for id_, score in result.result]
+    with timer.stage("lookup"):
+        rendered = await render_result(result)
+    timings = timer.finish()
+    metrics.observe(timings)
+    metrics.inc("search_requests_total", outcome=outcome)
+    response.headers["Server-Timing"] = timer.server_timing()
 
     return {
         "meta": {
-            "nq": result.nq,
-            "nlist": result.nlist,
-            "ndis": result.ndis,
-            "nheap_updates": result.nheap_updates,
-            "quantization_time": round(result.quantization_time, 2),
-            "search_time": round(result.search_time, 2),
+            **result_meta(result),
+            "exact_match": exact_match,
+            "phash_distance": near[0][1] if near else None,
+            "cache_hit": cached is not None,
+            "timings": timings,
         },
         "params": {
             "limit": limit,
             "k": k,
             "nprobe": nprobe,
             "max_codes": max_codes,
+            "ef_search": ef_search,
+            "max_distance": max_distance,
             "orb_scale_factor": orb_scale_factor,
+            "phash_radius": phash_radius,
         },
-        "result": images,
+        "result": rendered,
+    }
+
+
+@app.post("/search/descriptors")
+async def search_descriptors(
+    request: Request,
+    response: Response,
+    counts: Annotated[list[int] | None, Query()] = None,
+    limit: int = 5,
+    k: int | None = None,
+    nprobe: int | None = None,
+    max_codes: int | None = None,
+    ef_search: int | None = None,
+    max_distance: int | None = None,
+):
+    """
+    使用客户端提取好的 ORB 特征点搜索
+
+    请求体为 N×32 的 uint8 矩阵（application/octet-stream 或 application/x-npy），
+    counts 依次给出每张图片的特征点数量，不提供时视为一张图片
+    """
+    assert searcher is not None
+
+    timer = StageTimer()
+    k, nprobe, max_codes, ef_search = resolve_params(k, nprobe, max_codes, ef_search)
+    body = await request.body()
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    try:
+        with timer.stage("parse"):
+            des = parse_descriptors(body, content_type)
+    except ValueError as e:
+        metrics.inc("search_requests_total", outcome="error")
+        return {"error": str(e)}
+
+    counts = counts or [len(des)]
+    if sum(counts) != len(des) or min(counts) <= 0:
+        metrics.inc("search_requests_total", outcome="error")
+        return {"error": "counts 与特征点数量不一致"}
+
+    offsets = np.cumsum([0, *counts])
+    with timer.stage("search"):
+        results = await asyncio.gather(
+            *[
+                searcher.search(
+                    des[start:end], limit, k, nprobe, max_codes, ef_search, max_distance
+                )
+                for start, end in zip(offsets[:-1], offsets[1:])
+            ]
+        )
+    with timer.stage("lookup"):
+        rendered = [await render_result(result) for result in results]
+    timings = timer.finish()
+
+    # 每张图片的搜索分别计入各阶段的直方图，请求整体只计入 parse、lookup 和 total
+    metrics.observe({s: ms for s, ms in timer.timings.items() if s != "search"})
+    for result in results:
+        metrics.observe(result_timings(result))
+    metrics.inc("search_requests_total", len(results), outcome="descriptors")
+    response.headers["Server-Timing"] = timer.server_timing()
+
+    return {
+        "meta": {"timings": timings},
+        "params": {
+            "limit": limit,
+            "k": k,
+            "nprobe": nprobe,
+            "max_codes": max_codes,
+            "ef_search": ef_search,
+            "max_distance": max_distance,
+        },
+        "results": [
+            {
+                "meta": {
+                    **result_meta(result),
+                    "timings": {
+                        s: round(ms, 2) for s, ms in result_timings(result).items()
+                    },
+                },
+                "result": r,
+            }
+            for result, r in zip(results, rendered)
+        ],
     }
 
 
@@ -71,14 +461,153 @@ async def search(
 @click.option("--mmap", is_flag=True, help="使用 mmap 加载索引")
 @click.option("--host", default="127.0.0.1", show_default=True, help="绑定的主机地址")
 @click.option("--port", default=8080, show_default=True, help="绑定的端口")
-def server(db_dir: Path, name: str, mmap: bool, host: str, port: int):
+@click.option(
+    "--batch-size", default=8, show_default=True, help="每次合并搜索的最大请求数"
+)
+@click.option(
+    "--batch-wait",
+    default=2.0,
+    show_default=True,
+    help="合并搜索时等待后续请求的最长时间，单位毫秒",
+)
+@click.option(
+    "--search-threads", default=1, show_default=True, help="同时执行搜索的线程数"
+)
+@click.option(
+    "--cache-size",
+    default=1024,
+    show_default=True,
+    help="缓存最近多少次搜索的结果，0 为不缓存",
+)
+@click.option(
+    "--extract-workers",
+    default=os.cpu_count(),
+    show_default=True,
+    help="解码图片和提取特征点的并发数",
+)
+@click.option(
+    "--extract-executor",
+    "extract_mode",
+    type=click.Choice(["thread", "process"]),
+    default="thread",
+    show_default=True,
+    help="使用线程池还是进程池提取特征点",
+)
+@click.option(
+    "--phash-radius",
+    default=3,
+    show_default=True,
+    type=click.IntRange(-1, 7),
+    help="感知哈希的汉明距离不超过该值时直接返回已导入的图片，-1 为不使用",
+)
+@click.option(
+    "-w",
+    "--workers",
+    default=1,
+    show_default=True,
+    help="服务进程数量，各进程共享同一份索引",
+)
+def server(
+    db_dir: Path,
+    name: str,
+    mmap: bool,
+    host: str,
+    port: int,
+    batch_size: int,
+    batch_wait: float,
+    search_threads: int,
+    cache_size: int,
+    extract_workers: int,
+    extract_mode: str,
+    phash_radius: int,
+    workers: int,
+):
     """
     启动一个 HTTP 服务，用于搜索图片
     """
-    connect(str(db_dir))
+    global path_table, phash_index, default_phash_radius
+    if path_table := PathTable.open(db_dir):
+        logger.info("已加载路径映射表：{} 个 ID", len(path_table))
+
+    # 感知哈希同样在 fork 之前加载
+    default_phash_radius = phash_radius
+    if phash_radius >= 0:
+        connect(str(db_dir), vector=False, readonly=True)
+        phash_index = PhashIndex(*crud.phash.load())
+        logger.info("已加载感知哈希：{} 张图片", len(phash_index))
 
-    global index
+    # 索引在 fork 之前加载，各个 worker 通过 mmap 或写时复制共享同一份内存
     m = FaissIndexManager(db_dir)
     index = m.get_index(name, mmap)
+    search_params.update(m.get_search_params(name))
+    logger.info("默认搜索参数：{}", search_params)
+
+    def setup():
+        global searcher, extract_executor, result_cache
+        connect(str(db_dir), vector=False, readonly=True)
+        searcher = BatchSearcher(
+            index,
+            batch_wait / 1000,
+            batch_size,
+            ThreadPoolExecutor(search_threads, "faiss-search"),
+        )
+        result_cache = LRUCache(cache_size)
+        if extract_mode == "process":
+            extract_executor = ProcessPoolExecutor(extract_workers)
+        else:
+            extract_executor = ThreadPoolExecutor(extract_workers, "extract")
+        if usage := memory_usage():
+            logger.info(
+                "worker {} 内存占用：RSS {:.1f} MB，共享 {:.1f} MB，私有 {:.1f} MB",
+                os.getpid(),
+                usage["rss"] / 2**20,
+                usage["shared"] / 2**20,
+                usage["private"] / 2**20,
+            )
+
+    if workers <= 1:
+        setup()
+        uvicorn.run(app, host=host, port=port)
+    else:
+        serve_workers(setup, host, port, workers)
+
+
+def serve_workers(setup: Callable[[], None], host: str, port: int, workers: int):
+    """
+    在父进程中绑定端口，然后 fork 出多个 worker 共同监听
+    """
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    logger.info("监听 {}:{}，启动 {} 个 worker", host, port, workers)
+
+    # 每个 worker 平分 CPU，避免 OpenMP 线程数超额
+    omp_threads = max(1, (os.cpu_count() or 1) // workers)
+
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                faiss.omp_set_num_threads(omp_threads)
+                setup()
+                config = uvicorn.Config(app, host=host, port=port)
+                uvicorn.Server(config).run(sockets=[sock])
+            except BaseException:
+                logger.exception("worker {} 异常退出", os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        pids.append(pid)
+
+    def stop(signum, frame):
+        for pid in pids:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
 
-    uvicorn.run(app, host=host, port=port)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in pids:
+        os.waitpid(pid, 0)
@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import click
+from loguru import logger
+from tqdm import tqdm
+
+from index.database import FlatVectorStore, FlatVectorWriter, connect, crud
+
+from .base import cli, click_db_dir
+
+
+@cli.group()
+def vector():
+    """
+    管理扁平向量存储（vector.idx / vector.dat）
+    """
+
+
+@vector.command("import")
+@click_db_dir
+def import_(db_dir: Path):
+    """
+    将 vector.db 中的向量追加到扁平向量存储，已导入的部分会被跳过
+    """
+    connect(str(db_dir), metadata=False, readonly=True)
+    count = 0
+    with FlatVectorWriter(db_dir) as writer:
+        logger.info("从图片 ID {} 开始导入", writer.next_id)
+        with tqdm(total=max(crud.vector.max_id() - writer.next_id + 1, 0)) as bar:
+            for v in crud.vector.iter_by(writer.next_id):
+                writer.append(v.id, v.vector)
+                count += 1
+                bar.update()
+    logger.info("导入 {} 张图片的向量", count)
+
+
+@vector.command()
+@click_db_dir
+@click.option(
+    "-b", "--batch", default=1000, show_default=True, help="每批写入的图片数量"
+)
+def export(db_dir: Path, batch: int):
+    """
+    将扁平向量存储中 vector.db 尚未包含的向量写回 vector.db
+    """
+    store = FlatVectorStore.open(db_dir)
+    if store is None:
+        raise click.UsageError("扁平向量存储不存在")
+    # 新建的 vector.db 中建表是异步完成的，不能立即查询
+    exists = (db_dir / "vector.db").exists()
+    connect(str(db_dir), metadata=False)
+    start = crud.vector.max_id() + 1 if exists else 0
+    logger.info("从图片 ID {} 开始导出", start)
+
+    count = 0
+    rows = []
+    for image_id in tqdm(range(start, len(store))):
+        if (v := store.get(image_id)) is None:
+            continue
+        rows.append((image_id, v))
+        if len(rows) == batch:
+            crud.vector.insert_many(rows)
+            count += len(rows)
+            rows = []
+    if rows:
+        crud.vector.insert_many(rows)
+        count += len(rows)
+    logger.info("导出 {} 张图片的向量", count)
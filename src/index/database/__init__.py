@@ -2,10 +2,19 @@ from pathlib import Path
 
 from .metadata import Image
 from .metadata import connect as connect_metadata
-from .vector import Vector
+from .pathtable import PathTable
+from .vector import FlatVectorStore, FlatVectorWriter, Vector, VectorReader
 from .vector import connect as connect_vector
 
-__all__ = ["Image", "Vector", "connect"]
+__all__ = [
+    "FlatVectorStore",
+    "FlatVectorWriter",
+    "Image",
+    "PathTable",
+    "Vector",
+    "VectorReader",
+    "connect",
+]
 
 
 def connect(
@@ -1 +1 @@
-from . import image, vector
+from . import image, phash, scan, vector
@@ -1,3 +1,8 @@
+from typing import Iterator
+
+import numpy as np
+from peewee import fn
+
 from ..metadata import Image, IndexStatus
 
 
@@ -8,6 +13,27 @@ def create(hash: bytes, path: str) -> int:
     return Image.create(hash=hash, path=path).id
 
 
+def insert_many(rows: list[tuple[int, bytes, str]]) -> None:
+    """
+    在一个事务中批量记录图片，rows 为 (ID, 哈希, 路径)
+    """
+    Image.insert_many(rows, fields=[Image.id, Image.hash, Image.path]).execute()
+
+
+def hash_prefixes() -> np.ndarray:
+    """
+    所有图片哈希的前 8 字节（小端 uint64），已排序
+    """
+    query = Image.select(fn.substr(Image.hash, 1, 8))
+    cursor = Image._meta.database.execute_sql(*query.sql())
+    chunks = []
+    while rows := cursor.fetchmany(65536):
+        chunks.append(b"".join(row[0] for row in rows))
+    prefixes = np.frombuffer(b"".join(chunks), dtype="<u8").astype(np.uint64)
+    prefixes.sort()
+    return prefixes
+
+
 def check_hash(hash: bytes) -> bool:
     """
     检查图片是否已存在
@@ -15,6 +41,13 @@ def check_hash(hash: bytes) -> bool:
     return Image.get_or_none(Image.hash == hash) is not None
 
 
+def get_by_hash(hash: bytes) -> Image | None:
+    """
+    通过哈希查询图片
+    """
+    return Image.get_or_none(Image.hash == hash)
+
+
 def get_by_id(image_id: int) -> Image:
     """
     通过ID查询图片
@@ -22,6 +55,28 @@ def get_by_id(image_id: int) -> Image:
     return Image.get_by_id(image_id)
 
 
+def get_paths(ids: list[int]) -> dict[int, str]:
+    """
+    通过一次查询批量获取图片路径
+    """
+    query = Image.select(Image.id, Image.path).where(Image.id.in_(ids))
+    return dict(query.tuples())
+
+
+def iter_paths() -> Iterator[tuple[int, str]]:
+    """
+    按 ID 顺序遍历所有图片的路径
+    """
+    return Image.select(Image.id, Image.path).order_by(Image.id).tuples().iterator()
+
+
+def max_id() -> int:
+    """
+    返回最大的图片 ID
+    """
+    return Image.select(fn.MAX(Image.id)).scalar() or 0
+
+
 def get_indexed(name: str) -> int:
     """
     返回已索引的图片数量
@@ -38,3 +93,10 @@ def add_indexed(name: str, add: int):
     IndexStatus.update(indexed=IndexStatus.indexed + add).where(
         IndexStatus.name == name
     ).execute()
+
+
+def reset_indexed(name: str):
+    """
+    将已索引的图片数量清零
+    """
+    IndexStatus.update(indexed=0).where(IndexStatus.name == name).execute()
@@ -0,0 +1,39 @@
+import numpy as np
+
+from ..metadata import ImageHash
+
+__all__ = ["delete_after", "insert_many", "load"]
+
+
+def insert_many(rows: list[tuple[int, bytes]]) -> None:
+    """
+    在一个事务中批量记录感知哈希，rows 为 (图片 ID, 8 字节哈希)
+    """
+    ImageHash.insert_many(
+        [(id_, int.from_bytes(code, "little", signed=True)) for id_, code in rows],
+        fields=[ImageHash.id, ImageHash.phash],
+    ).execute()
+
+
+def load() -> tuple[np.ndarray, np.ndarray]:
+    """
+    所有图片的感知哈希，返回 (图片 ID, n×8 的 uint8 矩阵)
+    """
+    # 旧数据库中的表是异步创建的，可能尚不存在
+    if not ImageHash.table_exists():
+        return np.empty(0, dtype=np.int64), np.empty((0, 8), dtype=np.uint8)
+    query = ImageHash.select(ImageHash.id, ImageHash.phash)
+    cursor = ImageHash._meta.database.execute_sql(*query.sql())
+    chunks = []
+    while rows := cursor.fetchmany(65536):
+        chunks.append(np.array(rows, dtype=np.int64).reshape(-1, 2))
+    rows = np.concatenate(chunks) if chunks else np.empty((0, 2), dtype=np.int64)
+    codes = rows[:, 1].astype("<i8").view(np.uint8).reshape(-1, 8)
+    return rows[:, 0].copy(), codes
+
+
+def delete_after(image_id: int) -> int:
+    """
+    删除图片 ID 大于 image_id 的感知哈希，返回删除的数量
+    """
+    return ImageHash.delete().where(ImageHash.id > image_id).execute()
@@ -0,0 +1,42 @@
+import numpy as np
+
+from ..metadata import ScanEntry
+
+__all__ = ["fingerprints", "upsert_many"]
+
+
+def fingerprints() -> np.ndarray:
+    """
+    所有已扫描文件的指纹（小端 uint64），已排序
+    """
+    # 旧数据库中的表是异步创建的，可能尚不存在
+    if not ScanEntry.table_exists():
+        return np.empty(0, dtype=np.uint64)
+    query = ScanEntry.select(ScanEntry.fingerprint)
+    cursor = ScanEntry._meta.database.execute_sql(*query.sql())
+    chunks = []
+    while rows := cursor.fetchmany(65536):
+        chunks.append(np.array([row[0] for row in rows], dtype=np.int64))
+    result = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+    result = result.view(np.uint64)
+    result.sort()
+    return result
+
+
+def upsert_many(rows: list[tuple[str, int, int, int, bytes]]) -> None:
+    """
+    在一个事务中批量记录扫描过的文件，rows 为 (路径, 大小, 修改时间, inode, 指纹)
+    """
+    ScanEntry.replace_many(
+        [
+            (path, size, mtime, inode, int.from_bytes(fp, "little", signed=True))
+            for path, size, mtime, inode, fp in rows
+        ],
+        fields=[
+            ScanEntry.path,
+            ScanEntry.size,
+            ScanEntry.mtime,
+            ScanEntry.inode,
+            ScanEntry.fingerprint,
+        ],
+    ).execute()
@@ -1,11 +1,21 @@
-from typing import Generator
+from typing import Generator, Iterator
 
 import numpy as np
 from peewee import fn
 
 from ..vector import Vector
+from ..vector.sample import sample_vectors
 
-__all__ = ["create", "iter_by"]
+__all__ = [
+    "create",
+    "delete_after",
+    "get_many",
+    "insert_many",
+    "iter_by",
+    "iter_raw",
+    "max_id",
+    "sample",
+]
 
 
 def create(key: int, vector: np.ndarray) -> None:
@@ -15,24 +25,78 @@ def create(key: int, vector: np.ndarray) -> None:
     Vector.create(id=key, vector=vector)
 
 
-def iter_by(start: int, limit: int | None = None) -> Generator[Vector, None, None]:
+def insert_many(rows: list[tuple[int, np.ndarray]]) -> None:
+    """
+    批量创建向量记录
+    """
+    Vector.insert_many(rows, fields=[Vector.id, Vector.vector]).execute()
+
+
+def delete_after(image_id: int) -> int:
+    """
+    删除 ID 大于 image_id 的向量记录，返回删除的数量
+    """
+    return Vector.delete().where(Vector.id > image_id).execute()
+
+
+def max_id() -> int:
+    """
+    返回最大的向量记录 ID
+    """
+    return Vector.select(fn.MAX(Vector.id)).scalar() or 0
+
+
+def iter_by(
+    start: int, limit: int | None = None, end: int | None = None
+) -> Generator[Vector, None, None]:
     """
     遍历 [start, end) 的向量记录
     """
-    return (
-        Vector.select()
-        .where(Vector.id >= start)
-        .order_by(Vector.id)
-        .limit(limit)
-        .iterator()
-    )
+    query = Vector.select().where(Vector.id >= start)
+    if end is not None:
+        query = query.where(Vector.id < end)
+    return query.order_by(Vector.id).limit(limit).iterator()
+
+
+def iter_raw(
+    start: int, limit: int | None = None, end: int | None = None
+) -> Iterator[tuple[int, bytes]]:
+    """
+    通过原始游标遍历 [start, end) 的向量记录，返回 (ID, 特征点字节)，不创建模型实例
+    """
+    query = Vector.select(Vector.id, Vector.vector).where(Vector.id >= start)
+    if end is not None:
+        query = query.where(Vector.id < end)
+    sql, params = query.order_by(Vector.id).limit(limit).sql()
+    cursor = Vector._meta.database.execute_sql(sql, params)
+    while rows := cursor.fetchmany(1024):
+        yield from rows
+
+
+def get_many(ids: list[int]) -> list[tuple[int, np.ndarray]]:
+    """
+    通过原始游标批量读取向量记录，不存在的 ID 会被忽略
+    """
+    query = Vector.select(Vector.id, Vector.vector).where(Vector.id.in_(ids))
+    cursor = Vector._meta.database.execute_sql(*query.sql())
+    return [
+        (id_, np.frombuffer(blob, dtype=np.uint8).reshape(-1, 32))
+        for id_, blob in cursor.fetchall()
+    ]
 
 
-def sample(n: int) -> np.ndarray:
+def sample(
+    n: int,
+    per_image: int | None = None,
+    seed: int | None = None,
+    workers: int = 4,
+) -> np.ndarray:
     """
-    随机采样 n 个图片的向量
+    随机采样 n 个向量，per_image 不为空时每张图片最多取 per_image 个
     """
-    arr = np.concatenate(
-        [v.vector for v in Vector.select().order_by(fn.Random()).limit(n)]
+    low, high = Vector.select(fn.MIN(Vector.id), fn.MAX(Vector.id)).scalar(
+        as_tuple=True
     )
-    return arr
+    if low is None:
+        return np.empty((0, 32), dtype=np.uint8)
+    return sample_vectors(n, (low, high), get_many, per_image, seed, workers=workers)
@@ -3,7 +3,7 @@ import os
 from playhouse.sqliteq import SqliteQueueDatabase
 
 from .base import db
-from .models import Image, IndexStatus
+from .models import Image, ImageHash, IndexStatus, ScanEntry
 
 __all__ = ["Image", "connect"]
 
@@ -18,4 +18,4 @@ def connect(path: str | os.PathLike, readonly: bool = False):
         },
     )
     db.initialize(database)
-    database.create_tables([Image, IndexStatus])
+    database.create_tables([Image, ImageHash, IndexStatus, ScanEntry])
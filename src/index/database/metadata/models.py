@@ -12,3 +12,32 @@ class Image(db.Model):
 class IndexStatus(db.Model):
     name = CharField(primary_key=True)
     indexed = BigIntegerField(default=0)
+
+
+class ScanEntry(db.Model):
+    """
+    add 扫描过的文件，stat 信息不变的文件在下次扫描时直接跳过
+    """
+
+    path = CharField(primary_key=True)
+    size = BigIntegerField()
+    mtime = BigIntegerField()
+    inode = BigIntegerField()
+    # 路径和 stat 信息哈希的前 8 字节，按有符号整数存储
+    fingerprint = BigIntegerField()
+
+    class Meta:
+        table_name = "scan"
+
+
+class ImageHash(db.Model):
+    """
+    图片的 64 位感知哈希，用于查找重新编码或缩放过的近似重复图片
+    """
+
+    id = BigIntegerField(primary_key=True)
+    # 按小端有符号整数存储
+    phash = BigIntegerField()
+
+    class Meta:
+        table_name = "phash"
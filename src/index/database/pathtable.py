@@ -0,0 +1,77 @@
+import mmap
+import os
+from pathlib import Path
+
+import numpy as np
+
+from . import crud
+
+__all__ = ["PathTable"]
+
+
+class PathTable:
+    """
+    只读的图片 ID 到路径的映射表，由 offsets 和字符串两个文件组成，通过 mmap 加载
+
+    第 i 张图片的路径为 data[offsets[i]:offsets[i + 1]]，表中不存在的图片回退到数据库查询
+    """
+
+    index_name = "paths.idx"
+    data_name = "paths.dat"
+
+    def __init__(self, db_dir: Path):
+        self.offsets = np.memmap(db_dir / self.index_name, dtype=np.uint64, mode="r")
+        with open(db_dir / self.data_name, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = b""
+
+    @classmethod
+    def open(cls, db_dir: Path) -> "PathTable | None":
+        """
+        加载映射表，不存在时返回 None
+        """
+        if not (db_dir / cls.index_name).exists():
+            return None
+        return cls(db_dir)
+
+    @classmethod
+    def build(cls, db_dir: Path) -> int:
+        """
+        根据数据库重建映射表，返回记录数量
+        """
+        offsets = [0]
+        count = 0
+        with open(db_dir / f"{cls.data_name}.tmp", "wb") as f:
+            for id_, path in crud.image.iter_paths():
+                # 图片 ID 可能不连续，缺失的 ID 对应空字符串
+                offsets.extend([offsets[-1]] * (id_ - len(offsets) + 1))
+                data = path.encode()
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+                count += 1
+        np.array(offsets, dtype=np.uint64).tofile(db_dir / f"{cls.index_name}.tmp")
+        os.replace(db_dir / f"{cls.data_name}.tmp", db_dir / cls.data_name)
+        os.replace(db_dir / f"{cls.index_name}.tmp", db_dir / cls.index_name)
+        return count
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def get(self, image_id: int) -> str | None:
+        if not 0 <= image_id < len(self):
+            return None
+        start, end = self.offsets[image_id], self.offsets[image_id + 1]
+        if start == end:
+            return None
+        return self.data[start:end].decode()
+
+    def lookup(self, ids: list[int]) -> list[str]:
+        """
+        批量查询图片路径，表中没有的 ID 通过一次数据库查询补全
+        """
+        paths = {id_: path for id_ in ids if (path := self.get(id_)) is not None}
+        if missing := [id_ for id_ in ids if id_ not in paths]:
+            paths |= crud.image.get_paths(missing)
+        return [paths[id_] for id_ in ids]
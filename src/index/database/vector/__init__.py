@@ -1,9 +1,18 @@
 from playhouse.sqliteq import SqliteQueueDatabase
 
 from .base import db
+from .flat import FlatVectorStore, FlatVectorWriter
 from .models import Vector
+from .reader import VectorChunk, VectorReader
 
-__all__ = ["Vector", "connect"]
+__all__ = [
+    "FlatVectorStore",
+    "FlatVectorWriter",
+    "Vector",
+    "VectorChunk",
+    "VectorReader",
+    "connect",
+]
 
 
 def connect(path: str, readonly: bool = False):
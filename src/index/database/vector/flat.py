@@ -0,0 +1,198 @@
+import mmap
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .sample import DIM, sample_vectors
+
+__all__ = ["FlatVectorStore", "FlatVectorWriter"]
+
+
+class FlatVectorStore:
+    """
+    只追加的扁平向量存储，由 offsets 和特征点两个文件组成，通过 mmap 加载
+
+    第 i 张图片的特征点为 data[offsets[i]:offsets[i + 1]]，offsets 以特征点（32 字节）为单位，
+    不存在的图片对应空区间
+    """
+
+    index_name = "vector.idx"
+    data_name = "vector.dat"
+
+    def __init__(self, db_dir: Path):
+        self.offsets = np.memmap(db_dir / self.index_name, dtype=np.uint64, mode="r")
+        # offsets 之后的数据可能是写入中断留下的，不可见
+        total = int(self.offsets[-1])
+        if total:
+            self.data = np.memmap(
+                db_dir / self.data_name, dtype=np.uint8, mode="r", shape=(total, DIM)
+            )
+        else:
+            self.data = np.empty((0, DIM), dtype=np.uint8)
+
+    @classmethod
+    def open(cls, db_dir: Path) -> "FlatVectorStore | None":
+        """
+        加载向量存储，不存在时返回 None
+        """
+        if not (db_dir / cls.index_name).exists():
+            return None
+        return cls(db_dir)
+
+    def __len__(self) -> int:
+        """
+        存储覆盖的图片 ID 上界（不含）
+        """
+        return len(self.offsets) - 1
+
+    @property
+    def ntotal(self) -> int:
+        return len(self.data)
+
+    def get(self, image_id: int) -> np.ndarray | None:
+        if not 0 <= image_id < len(self):
+            return None
+        start, end = self.offsets[image_id], self.offsets[image_id + 1]
+        if start == end:
+            return None
+        return self.data[start:end]
+
+    def slice(
+        self, start: int, end: int | None = None
+    ) -> tuple[np.ndarray, np.ndarray, int]:
+        """
+        读取 [start, end) 范围内图片的特征点，返回 (xids, vectors, 图片数量)
+
+        vectors 是 mmap 的视图，不会复制数据；xids 为 图片 ID << 10 | 特征点序号
+        """
+        start = min(max(start, 0), len(self))
+        end = len(self) if end is None else min(max(end, start), len(self))
+        counts = np.diff(self.offsets[start : end + 1]).astype(np.int64)
+
+        first = self.offsets[start]
+        vectors = self.data[first : self.offsets[end]]
+        ids = np.repeat(np.arange(start, end, dtype=np.uint64), counts)
+        # 每个特征点在所属图片中的序号
+        rank = np.arange(len(vectors), dtype=np.uint64) - (
+            np.repeat(self.offsets[start:end], counts) - first
+        )
+        return ids << np.uint64(10) | rank, vectors, np.count_nonzero(counts)
+
+    def prefetch(self, vectors: np.ndarray):
+        """
+        提示内核预读 vectors（data 的切片）所在的页
+        """
+        if not isinstance(self.data, np.memmap) or not len(vectors):
+            return
+        start = vectors.ctypes.data - self.data.ctypes.data
+        aligned = start - start % mmap.PAGESIZE
+        self.data._mmap.madvise(
+            mmap.MADV_WILLNEED, aligned, start + vectors.nbytes - aligned
+        )
+
+    def iter_chunks(
+        self, start: int, end: int | None, limit: int | None, chunk_size: int
+    ):
+        """
+        按每批 chunk_size 张图片遍历 [start, end) 范围，生成 (xids, vectors, 图片数量, 最后一张图片 ID)
+        """
+        start = min(max(start, 0), len(self))
+        end = len(self) if end is None else min(max(end, start), len(self))
+        nonempty = start + np.flatnonzero(np.diff(self.offsets[start : end + 1]))
+        if limit is not None:
+            nonempty = nonempty[:limit]
+        # 跳过空洞，使每批恰好包含 chunk_size 张图片（除最后一批）
+        for i in range(0, len(nonempty), chunk_size):
+            batch = nonempty[i : i + chunk_size]
+            xids, vectors, count = self.slice(int(batch[0]), int(batch[-1]) + 1)
+            yield xids, vectors, count, int(batch[-1])
+
+    def sample(
+        self,
+        n: int,
+        per_image: int | None = None,
+        seed: int | None = None,
+        workers: int = 4,
+    ) -> np.ndarray:
+        """
+        随机采样 n 个向量，per_image 不为空时每张图片最多取 per_image 个
+        """
+        nonempty = np.flatnonzero(np.diff(self.offsets))
+        if not len(nonempty):
+            return np.empty((0, DIM), dtype=np.uint8)
+
+        def read(ids: list[int]):
+            return [(i, v) for i in ids if (v := self.get(i)) is not None]
+
+        id_range = (int(nonempty[0]), int(nonempty[-1]))
+        return sample_vectors(n, id_range, read, per_image, seed, workers=workers)
+
+
+class FlatVectorWriter:
+    """
+    向扁平向量存储追加图片的特征点，图片 ID 必须递增
+    """
+
+    def __init__(self, db_dir: Path):
+        index_path = db_dir / FlatVectorStore.index_name
+        data_path = db_dir / FlatVectorStore.data_name
+        if not index_path.exists():
+            data_path.write_bytes(b"")
+            np.zeros(1, dtype=np.uint64).tofile(index_path)
+
+        # 丢弃写入中断时留下的不完整记录
+        offsets = np.fromfile(index_path, dtype=np.uint64)
+        size = os.path.getsize(data_path) // DIM
+        valid = int(np.searchsorted(offsets, size, side="right"))
+        offsets = offsets[:valid]
+        os.truncate(index_path, valid * 8)
+        os.truncate(data_path, int(offsets[-1]) * DIM)
+
+        self.index_path = index_path
+        self.data_path = data_path
+        self.next_id = len(offsets) - 1
+        self.offset = int(offsets[-1])
+        self.index_file = open(index_path, "ab")
+        self.data_file = open(data_path, "ab")
+
+    def append(self, image_id: int, vector: np.ndarray):
+        if image_id < self.next_id:
+            raise ValueError(f"图片 ID {image_id} 小于存储中的下一个 ID {self.next_id}")
+        self.data_file.write(np.ascontiguousarray(vector, dtype=np.uint8).tobytes())
+        # 缺失的 ID 对应空区间
+        gap = image_id - self.next_id
+        self.offset += len(vector)
+        offsets = np.full(gap + 1, self.offset, dtype=np.uint64)
+        offsets[:gap] = self.offset - len(vector)
+        self.index_file.write(offsets.tobytes())
+        self.next_id = image_id + 1
+
+    def truncate(self, next_id: int):
+        """
+        丢弃 ID 不小于 next_id 的图片
+        """
+        if next_id >= self.next_id:
+            return
+        self.flush()
+        offsets = np.fromfile(self.index_path, dtype=np.uint64, count=next_id + 1)
+        os.truncate(self.index_path, (next_id + 1) * 8)
+        os.truncate(self.data_path, int(offsets[-1]) * DIM)
+        self.next_id = next_id
+        self.offset = int(offsets[-1])
+
+    def flush(self):
+        # 先写特征点再写 offsets，中断时 offsets 不会指向不存在的数据
+        self.data_file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        self.flush()
+        self.data_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
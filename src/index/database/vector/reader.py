@@ -0,0 +1,150 @@
+import threading
+from dataclasses import dataclass, field
+from queue import Queue
+from typing import Iterator
+
+import numpy as np
+
+from .. import crud
+from .flat import FlatVectorStore
+from .sample import DIM
+
+__all__ = ["VectorChunk", "VectorReader"]
+
+
+@dataclass
+class VectorChunk:
+    # 图片 ID << 10 | 特征点序号
+    xids: np.ndarray
+    vectors: np.ndarray
+    # 本批包含的图片数量
+    count: int
+    # 本批最后一张图片的 ID
+    last_id: int
+    _buffer: "_Buffer | None" = field(default=None, repr=False)
+
+
+class _Buffer:
+    """
+    预分配的读取缓冲区，容量不足时按两倍扩容
+    """
+
+    def __init__(self, capacity: int):
+        self.xids = np.empty(capacity, dtype=np.uint64)
+        self.vectors = np.empty((capacity, DIM), dtype=np.uint8)
+        self.size = 0
+
+    def reserve(self, n: int):
+        if self.size + n <= len(self.xids):
+            return
+        capacity = max(len(self.xids) * 2, self.size + n)
+        xids = np.empty(capacity, dtype=np.uint64)
+        vectors = np.empty((capacity, DIM), dtype=np.uint8)
+        xids[: self.size] = self.xids[: self.size]
+        vectors[: self.size] = self.vectors[: self.size]
+        self.xids, self.vectors = xids, vectors
+
+
+# 特征点序号，每张图片最多 1024 个特征点
+_RANKS = np.arange(1 << 10, dtype=np.uint64)
+
+
+class VectorReader:
+    """
+    在后台线程中按批读取 [start, end) 的向量，预先读取 prefetch 批，使添加索引的线程不必等待读取
+
+    优先从扁平向量存储中切片读取，存储未覆盖的部分通过原始游标从 vector.db 读入预分配的缓冲区。
+    迭代得到的 VectorChunk 在取下一批之前有效，之后其缓冲区会被复用。
+    max_descriptors 不为空时每张图片只读取序号小于它的特征点
+    """
+
+    def __init__(
+        self,
+        start: int,
+        end: int | None = None,
+        limit: int | None = None,
+        chunk_size: int = 50000,
+        prefetch: int = 2,
+        store: FlatVectorStore | None = None,
+        max_descriptors: int | None = None,
+    ):
+        self.start = start
+        self.end = end
+        self.limit = limit
+        self.chunk_size = chunk_size
+        self.store = store
+        self.max_descriptors = max_descriptors or 1 << 10
+        self.ready: Queue[VectorChunk | Exception | None] = Queue(prefetch)
+        self.free: Queue[_Buffer] = Queue()
+        # 正在填充、排队和正在使用的缓冲区最多 prefetch + 2 个，按需分配
+        self.buffers = prefetch + 2
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __iter__(self) -> Iterator[VectorChunk]:
+        while (r := self.ready.get()) is not None:
+            if isinstance(r, Exception):
+                raise r
+            yield r
+            if r._buffer is not None:
+                self.free.put(r._buffer)
+
+    def _run(self):
+        try:
+            self._read()
+        except Exception as e:
+            self.ready.put(e)
+        else:
+            self.ready.put(None)
+
+    def _read(self):
+        start, limit = self.start, self.limit
+        if self.store is not None:
+            for xids, vectors, count, last_id in self.store.iter_chunks(
+                start, self.end, limit, self.chunk_size
+            ):
+                self.store.prefetch(vectors)
+                if self.max_descriptors < 1 << 10:
+                    keep = (xids & np.uint64(0x3FF)) < self.max_descriptors
+                    xids, vectors = xids[keep], vectors[keep]
+                self.ready.put(VectorChunk(xids, vectors, count, last_id))
+                if limit is not None:
+                    limit -= count
+            start = max(start, len(self.store))
+            if limit == 0 or (self.end is not None and start >= self.end):
+                return
+
+        buffer, count, last_id = self._get_buffer(), 0, 0
+        for last_id, blob in crud.vector.iter_raw(start, limit, self.end):
+            vector = np.frombuffer(blob, dtype=np.uint8).reshape(-1, DIM)
+            n = min(len(vector), self.max_descriptors)
+            buffer.reserve(n)
+            buffer.vectors[buffer.size : buffer.size + n] = vector[:n]
+            buffer.xids[buffer.size : buffer.size + n] = last_id << 10 | _RANKS[:n]
+            buffer.size += n
+            count += 1
+            if count == self.chunk_size:
+                self._put(buffer, count, last_id)
+                buffer, count = self._get_buffer(), 0
+        if count:
+            self._put(buffer, count, last_id)
+        else:
+            self.free.put(buffer)
+
+    def _get_buffer(self) -> _Buffer:
+        if self.free.empty() and self.buffers:
+            self.buffers -= 1
+            # 平均每张图片 500 个特征点
+            return _Buffer(self.chunk_size * 500)
+        return self.free.get()
+
+    def _put(self, buffer: _Buffer, count: int, last_id: int):
+        chunk = VectorChunk(
+            buffer.xids[: buffer.size],
+            buffer.vectors[: buffer.size],
+            count,
+            last_id,
+            buffer,
+        )
+        buffer.size = 0
+        self.ready.put(chunk)
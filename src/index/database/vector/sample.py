@@ -0,0 +1,87 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable
+
+import numpy as np
+
+__all__ = ["sample_vectors"]
+
+DIM = 32
+# 每张图片的平均特征点数量，用于估计需要抽取的图片数量
+AVG_FEATURES = 500
+
+
+def sample_vectors(
+    n: int,
+    id_range: tuple[int, int],
+    read: Callable[[list[int]], Iterable[tuple[int, np.ndarray]]],
+    per_image: int | None = None,
+    seed: int | None = None,
+    batch: int = 1000,
+    workers: int = 4,
+) -> np.ndarray:
+    """
+    从 [low, high] 范围内随机抽取图片，返回恰好 n 个特征点（不足时返回全部）
+
+    按 ID 随机抽取而不是对整个表排序，不存在的 ID 会在下一轮补抽。per_image 不为空时每张图片
+    最多随机取 per_image 个特征点。read 按批读取 [(图片 ID, 特征点)]，由 workers 个线程并行调用，
+    结果按抽取顺序写入预分配的数组，相同的 seed 得到相同的结果
+    """
+    low, high = id_range
+    rng = np.random.default_rng(seed)
+    # 每张图片内部的抽样只取决于 seed 和图片 ID
+    base = int(rng.integers(1 << 32))
+    out = np.empty((n, DIM), dtype=np.uint8)
+    filled = 0
+    drawn = np.empty(0, dtype=np.int64)
+    per_image_est = min(per_image or AVG_FEATURES, AVG_FEATURES)
+
+    with ThreadPoolExecutor(workers) as executor:
+        while filled < n and len(drawn) < high - low + 1:
+            # 多抽 20% 弥补不存在的 ID 和特征点较少的图片
+            want = math.ceil((n - filled) / per_image_est * 1.2) + 1
+            ids = _draw(rng, low, high, drawn, want)
+            drawn = np.union1d(drawn, ids)
+            batches = [ids[i : i + batch].tolist() for i in range(0, len(ids), batch)]
+            # 每次只并行读取 workers 批，限制同时在内存中的图片数量
+            for i in range(0, len(batches), workers):
+                window = batches[i : i + workers]
+                for ids_batch, rows in zip(
+                    window, executor.map(lambda b: dict(read(b)), window)
+                ):
+                    # 按抽取顺序而不是 ID 顺序处理，保证结果只取决于 seed
+                    for image_id in ids_batch:
+                        if (vector := rows.get(image_id)) is None:
+                            continue
+                        if per_image is not None and len(vector) > per_image:
+                            sub = np.random.default_rng([base, image_id])
+                            pick = sub.choice(len(vector), per_image, replace=False)
+                            vector = vector[pick]
+                        take = min(len(vector), n - filled)
+                        out[filled : filled + take] = vector[:take]
+                        filled += take
+                        if filled == n:
+                            return out
+    return out[:filled]
+
+
+def _draw(
+    rng: np.random.Generator, low: int, high: int, drawn: np.ndarray, want: int
+) -> np.ndarray:
+    """
+    从 [low, high] 中抽取最多 want 个未抽过的 ID
+    """
+    remaining = high - low + 1 - len(drawn)
+    want = min(want, remaining)
+    if remaining <= want * 4:
+        # 剩余的 ID 不多时直接从剩余集合中抽取
+        pool = np.setdiff1d(np.arange(low, high + 1), drawn)
+        return rng.choice(pool, want, replace=False)
+    ids = np.empty(0, dtype=np.int64)
+    while len(ids) < want:
+        candidates = rng.integers(low, high + 1, (want - len(ids)) * 2)
+        candidates = candidates[~np.isin(candidates, drawn)]
+        # 去重并保持抽取顺序
+        _, first = np.unique(np.concatenate([ids, candidates]), return_index=True)
+        ids = np.concatenate([ids, candidates])[np.sort(first)]
+    return ids[:want]
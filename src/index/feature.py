@@ -1,9 +1,19 @@
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
 import cv2
 import numpy as np
 from cv2.typing import MatLike
 from python_orb_slam3 import ORBExtractor
 
-__all__ = ["FeatureExtractor"]
+__all__ = [
+    "FeatureExtractor",
+    "FeatureExtractorPool",
+    "default_scale_factor",
+    "dhash",
+    "sort_by_response",
+]
 
 
 class FeatureExtractor:
@@ -25,3 +35,65 @@ class FeatureExtractor:
         if len(kps) == 0:
             return [], np.array([])
         return kps, des
+
+
+def default_scale_factor(img: MatLike) -> float:
+    """
+    根据图片宽度选择 ORB 金字塔的缩放系数，小图使用更密的金字塔
+    """
+    return 0.9 if img.shape[1] <= 400 else 1.2
+
+
+def sort_by_response(kps: list[cv2.KeyPoint], des: np.ndarray) -> np.ndarray:
+    """
+    将特征点按响应值从大到小排序，ORB-SLAM3 返回的特征点按金字塔层级排列
+    """
+    order = np.argsort([-kp.response for kp in kps], kind="stable")
+    return des[order]
+
+
+def dhash(img: MatLike) -> bytes | None:
+    """
+    64 位差值哈希：缩小到 9×8 后比较每行相邻像素的亮度，对重新编码和缩放不敏感
+
+    几乎没有明暗变化的图片（如空白页）的哈希只反映噪声，返回 None
+    """
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    if np.ptp(small) < 16:
+        return None
+    return np.packbits(small[:, 1:] > small[:, :-1]).tobytes()
+
+
+class FeatureExtractorPool:
+    """
+    按 scale_factor 复用 FeatureExtractor，同一个实例同一时间只会被一个线程使用
+
+    只复用 pooled 中的缩放系数，其他值每次新建，避免保留任意多个实例
+    """
+
+    def __init__(
+        self,
+        n_features: int = 500,
+        n_levels: int = 8,
+        pooled: tuple[float, ...] = (0.9, 1.2),
+    ):
+        self.n_features = n_features
+        self.n_levels = n_levels
+        self._free: dict[float, list[FeatureExtractor]] = {s: [] for s in pooled}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def get(self, scale_factor: float = 1.2) -> Iterator[FeatureExtractor]:
+        free = self._free.get(scale_factor)
+        ft = None
+        if free is not None:
+            with self._lock:
+                ft = free.pop() if free else None
+        if ft is None:
+            ft = FeatureExtractor(self.n_features, scale_factor, self.n_levels)
+        try:
+            yield ft
+        finally:
+            if free is not None:
+                with self._lock:
+                    free.append(ft)
@@ -1,2 +1,5 @@
-from .index import FaissIndexManager
+from .batch import BatchSearcher
+from .index import FaissIndex, FaissIndexManager
+from .phash import PhashIndex
+from .shard import ShardedFaissIndex
 from .train import FaissIndexTrainer
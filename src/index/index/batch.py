@@ -0,0 +1,136 @@
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from time import perf_counter
+
+import numpy as np
+
+from .index import FaissIndex, FaissSearchResult, aggregate_matches
+from .shard import ShardedFaissIndex
+
+
+@dataclass
+class _Request:
+    vectors: np.ndarray
+    limit: int
+    max_distance: int | None
+    future: asyncio.Future = field(repr=False)
+    created: float = field(default_factory=perf_counter)
+
+
+class BatchSearcher:
+    """
+    将一段时间内到达的搜索请求合并为一次 faiss 搜索
+
+    k、nprobe、max_codes、efSearch 相同的请求才会被合并，
+    结果按请求拆分后再分别聚合打分
+    """
+
+    def __init__(
+        self,
+        index: FaissIndex | ShardedFaissIndex,
+        max_wait: float = 0.002,
+        max_batch: int = 8,
+        executor: Executor | None = None,
+    ):
+        self.index = index
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        # faiss 内部已经使用 OpenMP 多线程，默认同一时间只执行一个批次
+        self.executor = executor or ThreadPoolExecutor(1, "faiss-search")
+        self._pending: dict[tuple, list[_Request]] = {}
+        self._timers: dict[tuple, asyncio.TimerHandle] = {}
+        # 已提交到线程池但尚未完成的批次数量
+        self.running = 0
+        # 事件循环只保留任务的弱引用，执行中的任务需要在这里持有
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        等待合并的请求数量
+        """
+        return sum(len(batch) for batch in self._pending.values())
+
+    async def search(
+        self,
+        vectors: np.ndarray,
+        limit: int = 10,
+        k: int = 3,
+        nprobe: int = 1,
+        max_codes: int = 0,
+        efSearch: int = 16,
+        max_distance: int | None = None,
+    ) -> FaissSearchResult:
+        """
+        参数与 FaissIndex.search 相同
+        """
+        loop = asyncio.get_running_loop()
+        key = (k, nprobe, max_codes, efSearch)
+        req = _Request(vectors, limit, max_distance, loop.create_future())
+
+        pending = self._pending.setdefault(key, [])
+        pending.append(req)
+        if len(pending) >= self.max_batch:
+            self._flush(key)
+        elif len(pending) == 1:
+            self._timers[key] = loop.call_later(self.max_wait, self._flush, key)
+
+        return await req.future
+
+    def _flush(self, key: tuple):
+        if timer := self._timers.pop(key, None):
+            timer.cancel()
+        batch = self._pending.pop(key, [])
+        if batch:
+            task = asyncio.ensure_future(self._execute(key, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, key: tuple, batch: list[_Request]):
+        loop = asyncio.get_running_loop()
+        self.running += 1
+        try:
+            results = await loop.run_in_executor(
+                self.executor, self._search, key, batch
+            )
+        except Exception as e:
+            for req in batch:
+                if not req.future.done():
+                    req.future.set_exception(e)
+            return
+        finally:
+            self.running -= 1
+        for req, result in zip(batch, results):
+            if not req.future.done():
+                req.future.set_result(result)
+
+    def _search(self, key: tuple, batch: list[_Request]) -> list[FaissSearchResult]:
+        k, nprobe, max_codes, efSearch = key
+        # 从请求到达到批次开始执行的时间，包括合并等待和线程池排队
+        started = perf_counter()
+        vectors = np.concatenate([req.vectors for req in batch])
+        raw = self.index.search_raw(vectors, k, nprobe, max_codes, efSearch)
+
+        results = []
+        offset = 0
+        for req in batch:
+            end = offset + len(req.vectors)
+            t0 = perf_counter()
+            kws = aggregate_matches(
+                raw.labels[offset:end],
+                raw.distances[offset:end],
+                req.limit,
+                req.max_distance,
+            )
+            results.append(
+                FaissSearchResult(
+                    **raw.stats(offset, end),
+                    result=kws,
+                    batch_size=len(batch),
+                    aggregate_time=(perf_counter() - t0) * 1000,
+                    queue_time=(started - req.created) * 1000,
+                )
+            )
+            offset = end
+        return results
@@ -0,0 +1,131 @@
+import os
+import threading
+from pathlib import Path
+from queue import Queue
+
+import faiss
+import numpy as np
+from loguru import logger
+
+__all__ = ["DeltaLog", "delta_path", "replay_delta"]
+
+MAGIC = b"IDXDELTA"
+# 文件头：MAGIC + 创建时索引的向量数量
+HEADER = np.dtype([("magic", "S8"), ("base_ntotal", "<i8")])
+# 每条记录：向量数量 + 最后一张图片 ID，之后是 assign、xids 和 codes
+RECORD = np.dtype([("n", "<i8"), ("last_id", "<i8")])
+
+
+def delta_path(index_path: Path) -> Path:
+    return index_path.with_name(index_path.name + ".delta")
+
+
+class DeltaLog:
+    """
+    索引的增量快照，在后台线程中按顺序追加每次添加的向量、所属倒排表和 ID
+
+    完整索引 + 增量快照即为当前索引，重放时使用记录的倒排表编号，结果与直接添加完全一致
+    """
+
+    def __init__(self, index_path: Path, base_ntotal: int):
+        self.path = delta_path(index_path)
+        self.file = open(self.path, "wb")
+        header = np.array([(MAGIC, base_ntotal)], dtype=HEADER)
+        self.file.write(header.tobytes())
+        # 写入跟不上时阻塞添加，避免积压过多数据
+        self.queue: Queue[tuple[np.ndarray, ...] | None] = Queue(2)
+        self.error: Exception | None = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def append(
+        self, assign: np.ndarray, xids: np.ndarray, codes: np.ndarray, last_id: int
+    ):
+        """
+        追加一批向量，数据会被复制，调用后可以立即复用传入的数组
+        """
+        if self.error is not None:
+            raise self.error
+        record = np.array([(len(xids), last_id)], dtype=RECORD)
+        self.queue.put(
+            (
+                record,
+                assign.astype("<i8"),
+                xids.astype("<i8"),
+                np.array(codes, dtype=np.uint8, copy=True),
+            )
+        )
+
+    def _run(self):
+        while (r := self.queue.get()) is not None:
+            try:
+                if self.error is None:
+                    for arr in r:
+                        self.file.write(arr.tobytes())
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+        self.queue.task_done()
+
+    def flush(self):
+        """
+        等待已追加的向量全部写入磁盘
+        """
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+def replay_delta(index: faiss.IndexBinaryIVF, index_path: Path) -> int | None:
+    """
+    将增量快照中尚未包含在完整索引里的记录添加到索引，返回最后一条记录的图片 ID
+
+    完整索引的向量数量标识了它包含哪些记录，因此合并后未删除的增量快照不会被重复添加；
+    写入中断的最后一条记录会被忽略。没有增量快照时返回 None
+    """
+    path = delta_path(index_path)
+    if not path.exists() or path.stat().st_size < HEADER.itemsize:
+        return None
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    header = np.frombuffer(data, dtype=HEADER, count=1)[0]
+    if header["magic"] != MAGIC:
+        raise ValueError(f"无效的增量快照文件 {path}")
+
+    ntotal = int(header["base_ntotal"])
+    offset = HEADER.itemsize
+    last_id = None
+    applied = 0
+    while offset + RECORD.itemsize <= len(data):
+        record = np.frombuffer(data, dtype=RECORD, count=1, offset=offset)[0]
+        n = int(record["n"])
+        size = RECORD.itemsize + n * (16 + index.code_size)
+        if offset + size > len(data):
+            break
+        offset += RECORD.itemsize
+        assign = np.frombuffer(data, dtype="<i8", count=n, offset=offset)
+        xids = np.frombuffer(data, dtype="<i8", count=n, offset=offset + n * 8)
+        codes = np.frombuffer(
+            data, dtype=np.uint8, count=n * index.code_size, offset=offset + n * 16
+        )
+        offset += n * (16 + index.code_size)
+        ntotal += n
+        # 已经合并到完整索引中的记录
+        if ntotal <= index.ntotal:
+            continue
+        index.add_core(
+            n, faiss.swig_ptr(codes), faiss.swig_ptr(xids), faiss.swig_ptr(assign)
+        )
+        last_id = int(record["last_id"])
+        applied += n
+    if applied:
+        logger.info("从增量快照恢复 {} 个特征点", applied)
+    return last_id
@@ -1,52 +1,211 @@
+import json
 import shutil
-from collections import defaultdict
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
+from time import perf_counter
+from typing import TYPE_CHECKING
 
 import faiss
 import numpy as np
 from loguru import logger
 
+from .delta import DeltaLog, delta_path, replay_delta
+from .ondisk import is_ondisk, ivfdata_paths
+
+if TYPE_CHECKING:
+    from .shard import ShardedFaissIndex
+
+
+# 没有调优结果时使用的搜索参数
+DEFAULT_SEARCH_PARAMS = {"k": 3, "nprobe": 4, "max_codes": 0, "efSearch": 16}
+
 
 @dataclass
 class FaissSearchResult:
     nq: int
     nlist: int
     ndis: int
-    nheap_updates: int
     quantization_time: float
     search_time: float
     result: list[tuple[int, float]]
+    batch_size: int = 1
+    # 按图片聚合打分和在合并队列中等待的耗时，单位毫秒
+    aggregate_time: float = 0.0
+    queue_time: float = 0.0
+
+
+@dataclass
+class FaissRawResult:
+    distances: np.ndarray
+    labels: np.ndarray
+    # 每个查询向量访问的倒排表数量和计算距离的次数
+    nlist: np.ndarray
+    ndis: np.ndarray
+    quantization_time: float
+    search_time: float
+
+    def stats(self, start: int = 0, end: int | None = None) -> dict:
+        """
+        统计 [start, end) 范围内查询向量的搜索信息
+        """
+        nlist, ndis = self.nlist[start:end], self.ndis[start:end]
+        return dict(
+            nq=len(nlist),
+            nlist=int(nlist.sum()),
+            ndis=int(ndis.sum()),
+            quantization_time=self.quantization_time,
+            search_time=self.search_time,
+        )
+
+
+def search_preassigned(
+    index: faiss.IndexBinaryIVF,
+    vectors: np.ndarray,
+    k: int,
+    coarse_dis: np.ndarray,
+    assign: np.ndarray,
+    max_codes: int = 0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    在粗量化结果指定的倒排表中搜索最近的 k 个特征点
+    """
+    params = faiss.SearchParametersIVF()
+    params.nprobe = assign.shape[1]
+    params.max_codes = max_codes
+
+    n = len(vectors)
+    distances = np.empty((n, k), dtype=np.int32)
+    labels = np.empty((n, k), dtype=np.int64)
+    index.search_preassigned_c(
+        n,
+        faiss.swig_ptr(vectors),
+        k,
+        faiss.swig_ptr(assign),
+        faiss.swig_ptr(coarse_dis),
+        faiss.swig_ptr(distances),
+        faiss.swig_ptr(labels),
+        False,
+        params,
+    )
+    return distances, labels
+
+
+def scan_stats(
+    list_sizes: np.ndarray, assign: np.ndarray, max_codes: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    根据粗量化结果和倒排表长度推算每个查询访问的倒排表数量和计算距离的次数
+    """
+    sizes = np.where(assign >= 0, list_sizes[assign], 0)
+    visited = (assign >= 0) & (sizes > 0)
+    if max_codes:
+        # 扫描到 max_codes 个向量后停止，最后一个倒排表只扫描一部分
+        scanned = np.cumsum(sizes, axis=1) - sizes
+        visited &= scanned < max_codes
+    ndis = np.where(visited, sizes, 0).sum(axis=1)
+    if max_codes:
+        ndis = np.minimum(ndis, max_codes)
+    return visited.sum(axis=1), ndis
 
 
-# TODO: 阻止并发访问
 class FaissIndex:
     def __init__(self, path: str, mmap: bool = False):
         """
         加载索引
         """
-        if mmap:
+        if mmap and is_ondisk(Path(path)):
+            # 倒排表已经在 .ivfdata 文件中并通过 mmap 读取
+            io_flags = faiss.IO_FLAG_READ_ONLY
+        elif mmap:
             io_flags = faiss.IO_FLAG_READ_ONLY | faiss.IO_FLAG_MMAP
         else:
             io_flags = 0
         self.path = path
         self.index: faiss.IndexBinaryIVF = faiss.read_index_binary(path, io_flags)
+        self.quantizer = faiss.downcast_IndexBinary(self.index.quantizer)
+        self._list_sizes: np.ndarray | None = None
+
+        # 完整索引文件中的向量数量，之后的向量来自增量快照
+        self._saved_ntotal = self.index.ntotal
+        self.delta: DeltaLog | None = None
+        if not mmap:
+            replay_delta(self.index, Path(path))
+        elif delta_path(Path(path)).exists():
+            logger.warning("索引 {} 有未合并的增量快照，继续构建索引后才能看到", path)
+
+    @property
+    def list_sizes(self) -> np.ndarray:
+        """
+        每个倒排表的长度
+        """
+        if self._list_sizes is None:
+            invlists = self.index.invlists
+            self._list_sizes = np.array(
+                [invlists.list_size(i) for i in range(self.index.nlist)],
+                dtype=np.int64,
+            )
+        return self._list_sizes
 
     def imbalance(self) -> float:
         """
         当前索引的不平衡度，1 为绝对平均
         """
-        arr = np.array([self.index.get_list_size(i) for i in range(self.index.nlist)])
+        arr = self.list_sizes
         uf = np.sum(arr.astype(np.float64) ** 2)
         tot = np.sum(arr).astype(np.float64)
         return float(uf * len(arr) / tot**2)
 
     def add_with_ids(self, vectors: np.ndarray, xids: np.ndarray):
         """
-        添加图片的特征点向量
+        添加图片的特征点向量，启用增量快照时同时在后台写入增量快照
+        """
+        if self.delta is None:
+            self.index.add_with_ids(vectors, xids)
+        else:
+            vectors = np.ascontiguousarray(vectors)
+            xids = np.ascontiguousarray(xids, dtype=np.int64)
+            _, assign = self.quantizer.search(vectors, 1)
+            assign = np.ascontiguousarray(assign[:, 0])
+            self.index.add_core(
+                len(xids),
+                faiss.swig_ptr(vectors),
+                faiss.swig_ptr(xids),
+                faiss.swig_ptr(assign),
+            )
+            self.delta.append(assign, xids, vectors, int(xids[-1]) >> 10)
+        self._list_sizes = None
+
+    def enable_delta(self):
+        """
+        启用增量快照：之后添加的向量在后台追加到 .delta 文件，snapshot 时无需重写整个索引
+        """
+        if self.index.ntotal != self._saved_ntotal:
+            self.save()
+        self.delta = DeltaLog(Path(self.path), self.index.ntotal)
+
+    def disable_delta(self):
+        """
+        合并增量快照并停止写入
+        """
+        if self.delta is None:
+            return
+        self.delta.close()
+        self.delta = None
+        if self.index.ntotal != self._saved_ntotal:
+            self.save()
+        else:
+            delta_path(Path(self.path)).unlink()
+
+    def snapshot(self, last_id: int):
+        """
+        记录检查点。启用增量快照时只等待增量快照写入磁盘，否则保存整个索引
         """
-        self.index.add_with_ids(vectors, xids)
+        if self.delta is None:
+            self.save(last_id)
+            return
+        self.delta.flush()
+        write_checkpoint(Path(self.path), last_id)
 
     def search(
         self,
@@ -56,50 +215,145 @@ class FaissIndex:
         nprobe: int = 1,
         max_codes: int = 0,
         efSearch: int = 16,
+        max_distance: int | None = None,
     ) -> FaissSearchResult:
         """
         搜索最近的特征点，返回图片 ID 和距离
+
+        max_distance 不为空时，汉明距离大于该值的匹配会在统计前被丢弃
+        """
+        raw = self.search_raw(vectors, k, nprobe, max_codes, efSearch)
+        t0 = perf_counter()
+        kws = aggregate_matches(raw.labels, raw.distances, limit, max_distance)
+        return FaissSearchResult(
+            **raw.stats(), result=kws, aggregate_time=(perf_counter() - t0) * 1000
+        )
+
+    def search_raw(
+        self,
+        vectors: np.ndarray,
+        k: int = 3,
+        nprobe: int = 1,
+        max_codes: int = 0,
+        efSearch: int = 16,
+    ) -> FaissRawResult:
         """
-        self.index.nprobe = nprobe
-        self.index.max_codes = max_codes
-        distances, labels = self.index.search(vectors, k)
-
-        labels >>= 10
-        kds = defaultdict(list)
-        for label, distance in zip(labels, distances):
-            # 如果某个特征点匹配到了同一图片中的多个特征点，只取最接近的一个
-            t = defaultdict(lambda: 256)
-            for l, d in zip(label, distance):
-                t[l] = min(t[l], d)
-            for l, d in t.items():
-                kds[l].append(d)
-
-        # 此处先按长度截取前 2 * limit 个，减少计算量
-        kls = sorted(kds.items(), key=lambda x: len(x[1]), reverse=True)
-        kws = sorted(
-            [(k, wilson_score(np.array(v))) for k, v in kls[: 2 * limit]],
-            key=lambda x: x[1],
-            reverse=True,
+        搜索最近的特征点，返回未经聚合的距离和标签
+
+        搜索参数只对本次调用生效，统计信息也不经过 faiss 的全局变量，因此可以并发调用
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.uint8)
+
+        t0 = perf_counter()
+        coarse_dis, assign = self.quantize(vectors, nprobe, efSearch)
+        t1 = perf_counter()
+        distances, labels = self.search_preassigned(
+            vectors, k, coarse_dis, assign, max_codes
         )
+        t2 = perf_counter()
 
-        result = FaissSearchResult(
-            nq=faiss.cvar.indexIVF_stats.nq,
-            nlist=faiss.cvar.indexIVF_stats.nlist,
-            ndis=faiss.cvar.indexIVF_stats.ndis,
-            nheap_updates=faiss.cvar.indexIVF_stats.nheap_updates,
-            quantization_time=faiss.cvar.indexIVF_stats.quantization_time,
-            search_time=faiss.cvar.indexIVF_stats.search_time,
-            result=kws[:limit],
+        nlist, ndis = self.scan_stats(assign, max_codes)
+        return FaissRawResult(
+            distances=distances,
+            labels=labels,
+            nlist=nlist,
+            ndis=ndis,
+            quantization_time=(t1 - t0) * 1000,
+            search_time=(t2 - t1) * 1000,
         )
-        faiss.cvar.indexIVF_stats.reset()
-        return result
 
-    def save(self):
+    def quantize(
+        self, vectors: np.ndarray, nprobe: int, efSearch: int = 16
+    ) -> tuple[np.ndarray, np.ndarray]:
         """
-        保存索引
+        粗量化，返回每个查询向量最近的 nprobe 个倒排表及其距离
+        """
+        quantizer_params = None
+        if isinstance(self.quantizer, faiss.IndexBinaryHNSW):
+            quantizer_params = faiss.SearchParametersHNSW()
+            quantizer_params.efSearch = efSearch
+        return self.quantizer.search(vectors, nprobe, params=quantizer_params)
+
+    def search_preassigned(
+        self,
+        vectors: np.ndarray,
+        k: int,
+        coarse_dis: np.ndarray,
+        assign: np.ndarray,
+        max_codes: int = 0,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        在粗量化结果指定的倒排表中搜索最近的 k 个特征点
+        """
+        return search_preassigned(self.index, vectors, k, coarse_dis, assign, max_codes)
+
+    def scan_stats(
+        self, assign: np.ndarray, max_codes: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        根据粗量化结果推算每个查询访问的倒排表数量和计算距离的次数
+        """
+        return scan_stats(self.list_sizes, assign, max_codes)
+
+    def save(self, last_id: int | None = None):
+        """
+        保存索引，并将 last_id（已添加的最后一张图片 ID）记录为检查点
+
+        检查点在索引之后替换，中断时索引中最多多出检查点之后的图片，由 resume 删除。
+        增量快照中的记录已经包含在完整索引中，会重新开始记录
         """
         faiss.write_index_binary(self.index, self.path + ".tmp")
         shutil.move(self.path + ".tmp", self.path)
+        self._saved_ntotal = self.index.ntotal
+        # 完整索引已经包含增量快照中的所有记录，重新开始记录
+        if self.delta is not None:
+            self.delta.close()
+            self.delta = DeltaLog(Path(self.path), self.index.ntotal)
+        else:
+            delta_path(Path(self.path)).unlink(missing_ok=True)
+        if last_id is not None:
+            write_checkpoint(Path(self.path), last_id)
+
+    def resume(self) -> int | None:
+        """
+        读取检查点，删除索引中检查点之后的图片，返回检查点；没有检查点时返回 None
+
+        索引与文件不一致时（删除了图片或恢复了增量快照）会保存完整索引
+        """
+        last_id = read_checkpoint(Path(self.path))
+        if last_id is None:
+            return None
+        selector = faiss.IDSelectorRange((last_id + 1) << 10, np.iinfo(np.int64).max)
+        if removed := self.index.remove_ids(selector):
+            logger.warning("删除检查点之后的 {} 个特征点", removed)
+            self._list_sizes = None
+        if removed or self.index.ntotal != self._saved_ntotal:
+            self.save(last_id)
+        return last_id
+
+
+def checkpoint_path(index_path: Path) -> Path:
+    return index_path.with_name(index_path.name + ".ckpt")
+
+
+def read_checkpoint(index_path: Path) -> int | None:
+    """
+    读取索引的检查点，即已添加到索引中的最后一张图片 ID
+    """
+    path = checkpoint_path(index_path)
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())["last_id"]
+
+
+def write_checkpoint(index_path: Path, last_id: int):
+    """
+    原子地写入索引的检查点
+    """
+    path = checkpoint_path(index_path)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps({"last_id": last_id}))
+    tmp.replace(path)
 
 
 class FaissIndexManager:
@@ -107,35 +361,204 @@ class FaissIndexManager:
         self.db_dir = db_dir
         self.description = description
 
-    def get_index(self, index_name: str, mmap: bool = False) -> FaissIndex:
-        trained_path = self.db_dir / f"{self.description}.train"
+    @property
+    def train_path(self) -> Path:
+        return self.db_dir / f"{self.description}.train"
 
+    def get_index(
+        self, index_name: str, mmap: bool = False
+    ) -> "FaissIndex | ShardedFaissIndex":
+        """
+        加载索引，如果索引是分片索引，则加载所有分片
+        """
+        if (ranges := self.get_shard_ranges(index_name)) is not None:
+            from .shard import ShardedFaissIndex
+
+            shards = [self.get_shard(index_name, i, mmap) for i in range(len(ranges))]
+            return ShardedFaissIndex(shards)
+        return FaissIndex(str(self.get_index_path(index_name)), mmap)
+
+    def get_shard(self, index_name: str, shard: int, mmap: bool = False) -> FaissIndex:
+        """
+        加载分片索引中的一个分片
+        """
+        return FaissIndex(str(self.get_index_path(index_name, shard)), mmap)
+
+    def find_index_path(self, index_name: str, shard: int | None = None) -> Path | None:
+        """
+        查找索引（或其中一个分片）的文件，不存在时返回 None
+        """
+        suffix = f"index.{index_name}"
+        if shard is not None:
+            suffix += f".shard{shard}"
+        return next(self.db_dir.glob(f"*.{suffix}"), None)
+
+    def get_index_path(self, index_name: str, shard: int | None = None) -> Path:
+        """
+        查找索引（或其中一个分片）的文件，不存在时从训练文件复制一份
+        """
+        if index_path := self.find_index_path(index_name, shard):
+            return index_path
+
+        suffix = f"index.{index_name}"
+        if shard is not None:
+            suffix += f".shard{shard}"
+
+        if not self.train_path.exists():
+            raise FileNotFoundError(f"索引文件 {suffix} 不存在")
+        index_path = self.db_dir / f"{self.description}.{suffix}"
+        shutil.copy(self.train_path, index_path)
+        return index_path
+
+    def reset_index(self, index_name: str, shard: int | None = None):
+        """
+        用训练文件覆盖索引（或其中一个分片），以便重新构建
+        """
+        index_path = self.get_index_path(index_name, shard)
+        for path in [index_path, *ivfdata_paths(index_path)]:
+            path.unlink()
+        checkpoint_path(index_path).unlink(missing_ok=True)
+        delta_path(index_path).unlink(missing_ok=True)
+        self.get_index_path(index_name, shard)
+
+    def create_shards(self, index_name: str, shards: int, max_id: int):
+        """
+        将 [1, max_id] 的图片 ID 平均划分到 shards 个分片中，最后一个分片不设上限
+        """
+        if self.get_shard_ranges(index_name) is not None:
+            raise FileExistsError(f"分片索引 {index_name} 已存在")
         if any(self.db_dir.glob(f"*.index.{index_name}")):
-            index_path = next(self.db_dir.glob(f"*.index.{index_name}"))
-        elif (self.db_dir / f"{self.description}.train").exists():
+            raise FileExistsError(f"索引 {index_name} 已存在且未分片")
+        size = max(1, -(-max_id // shards))
+        ranges = [[1 + i * size, 1 + (i + 1) * size] for i in range(shards)]
+        ranges[-1][1] = None
+        path = self.db_dir / f"{self.description}.index.{index_name}.shards"
+        path.write_text(json.dumps({"ranges": ranges}))
+
+    def get_params_path(self, index_name: str) -> Path:
+        """
+        保存调优后搜索参数的文件，位于索引文件（或分片清单）旁边
+        """
+        return self._sidecar_path(index_name, ".params.json")
+
+    def get_budget_path(self, index_name: str) -> Path:
+        """
+        记录构建时每张图片最多添加多少个特征点的文件，位于索引文件（或分片清单）旁边
+        """
+        return self._sidecar_path(index_name, ".budget.json")
+
+    def _sidecar_path(self, index_name: str, suffix: str) -> Path:
+        """
+        索引文件（或分片清单）旁边的文件，索引尚未创建时返回创建后对应的位置，不会创建索引
+        """
+        if manifest := next(self.db_dir.glob(f"*.index.{index_name}.shards"), None):
+            return manifest.with_suffix(suffix)
+        index_path = self.find_index_path(index_name)
+        if index_path is None:
+            if self.description is None:
+                raise FileNotFoundError(f"索引文件 index.{index_name} 不存在")
             index_path = self.db_dir / f"{self.description}.index.{index_name}"
-            shutil.copy(trained_path, index_path)
-        else:
-            raise FileNotFoundError(f"索引文件 {index_name} 不存在")
+        return index_path.with_name(index_path.name + suffix)
+
+    def get_max_descriptors(self, index_name: str) -> int | None:
+        """
+        索引中每张图片最多保留的特征点数量，None 为不限制
+        """
+        path = self.get_budget_path(index_name)
+        if not path.exists():
+            return None
+        return json.loads(path.read_text())["max_descriptors"]
+
+    def set_max_descriptors(self, index_name: str, max_descriptors: int | None):
+        self.get_budget_path(index_name).write_text(
+            json.dumps({"max_descriptors": max_descriptors})
+        )
+
+    def get_search_params(self, index_name: str) -> dict[str, int]:
+        """
+        索引的默认搜索参数，有调优结果时使用调优结果
+        """
+        params = dict(DEFAULT_SEARCH_PARAMS)
+        path = self.get_params_path(index_name)
+        if path.exists():
+            params.update(json.loads(path.read_text())["params"])
+        return params
+
+    def get_shard_ranges(self, index_name: str) -> list[tuple[int, int | None]] | None:
+        """
+        返回每个分片负责的图片 ID 范围 [start, end)，非分片索引返回 None
+        """
+        path = next(self.db_dir.glob(f"*.index.{index_name}.shards"), None)
+        if path is None:
+            return None
+        return [tuple(r) for r in json.loads(path.read_text())["ranges"]]
 
-        return FaissIndex(str(index_path), mmap)
-    
     def get_old_index(self, mmap: bool = False) -> FaissIndex:
         index_path = self.db_dir / "index"
         if not index_path.exists():
             raise FileNotFoundError("索引文件不存在")
         return FaissIndex(str(index_path), mmap)
 
+
+def aggregate_matches(
+    labels: np.ndarray,
+    distances: np.ndarray,
+    limit: int,
+    max_distance: int | None = None,
+) -> list[tuple[int, float]]:
+    """
+    将 faiss 返回的 (nq, k) 结果按图片聚合并打分，返回得分最高的 limit 张图片
+    """
+    nq, k = labels.shape
+    pos = np.arange(nq * k)
+    rows = pos // k
+    images = labels.ravel() >> 10
+    dis = distances.ravel()
+
+    mask = labels.ravel() >= 0
+    if max_distance is not None:
+        mask &= dis <= max_distance
+    pos, rows, images, dis = pos[mask], rows[mask], images[mask], dis[mask]
+    if len(images) == 0:
+        return []
+
+    # 如果某个特征点匹配到了同一图片中的多个特征点，只取最接近的一个
+    order = np.lexsort((dis, images, rows))
+    pos, rows, images, dis = pos[order], rows[order], images[order], dis[order]
+    first = np.ones(len(images), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (images[1:] != images[:-1])
+    pos, images, dis = pos[first], images[first], dis[first]
+
+    # 按图片分组，统计每张图片的匹配数量和得分的一阶、二阶矩
+    order = np.argsort(images, kind="stable")
+    pos, images, scores = pos[order], images[order], 1 - dis[order] / 256
+    ids, starts, counts = np.unique(images, return_index=True, return_counts=True)
+    sums = np.add.reduceat(scores, starts)
+    sqsums = np.add.reduceat(scores * scores, starts)
+
+    # 此处先按匹配数量截取前 2 * limit 个，减少计算量
+    # 数量相同时按首次出现的位置排序，与逐个特征点统计时的顺序一致
+    top = np.lexsort((np.minimum.reduceat(pos, starts), -counts))[: 2 * limit]
+    ids, counts = ids[top], counts[top]
+    mean = sums[top] / counts
+    var = np.maximum(sqsums[top] / counts - mean * mean, 0)
+    ws = np.round(_wilson(mean, var, counts) * 100, 2)
+
+    top = np.argsort(-ws, kind="stable")[:limit]
+    return [(int(i), float(w)) for i, w in zip(ids[top], ws[top])]
+
+
 # https://www.jianshu.com/p/4d2b45918958
 def wilson_score(scores: np.ndarray) -> float:
     scores = 1 - scores / 256
-    mean = np.mean(scores)
-    var = np.var(scores)
-    total = len(scores)
+    score = _wilson(np.mean(scores), np.var(scores), len(scores))
+    return round(score * 100, 2)
+
+
+def _wilson(mean, var, total):
     p_z = 1.98
-    score = (
+    return (
         mean
         + (np.square(p_z) / (2.0 * total))
         - ((p_z / (2.0 * total)) * np.sqrt(4.0 * total * var + np.square(p_z)))
     ) / (1 + np.square(p_z) / total)
-    return round(score * 100, 2)
@@ -0,0 +1,60 @@
+import time
+from pathlib import Path
+
+import faiss
+from loguru import logger
+
+__all__ = ["is_ondisk", "merge_ondisk"]
+
+
+def ivfdata_paths(index_path: Path) -> list[Path]:
+    """
+    索引对应的倒排表数据文件，按生成时间排序
+    """
+    return sorted(index_path.parent.glob(f"{index_path.name}.*.ivfdata"))
+
+
+def is_ondisk(index_path: Path) -> bool:
+    """
+    索引的倒排表是否存储在单独的 .ivfdata 文件中
+    """
+    return bool(ivfdata_paths(index_path))
+
+
+def merge_ondisk(template_path: Path, sources: list[Path], index_path: Path) -> int:
+    """
+    将多个索引的倒排表按顺序合并到磁盘上的 .ivfdata 文件中，写入 index_path，返回向量总数
+
+    所有索引必须由同一个训练文件创建。合并时以 mmap 方式读取，内存占用与索引大小无关。
+    每次合并都会写入一个新的 .ivfdata 文件，正在使用旧文件的进程不受影响
+    """
+    index = faiss.read_index_binary(str(template_path))
+    loaded = []
+    ils = faiss.InvertedListsPtrVector()
+    for path in sources:
+        flags = faiss.IO_FLAG_READ_ONLY
+        if not is_ondisk(path):
+            flags |= faiss.IO_FLAG_MMAP
+        src = faiss.read_index_binary(str(path), flags)
+        loaded.append(src)
+        ils.push_back(src.invlists)
+
+    old = ivfdata_paths(index_path)
+    ivfdata = index_path.with_name(f"{index_path.name}.{time.time_ns()}.ivfdata")
+    invlists = faiss.OnDiskInvertedLists(
+        index.nlist, index.code_size, str(ivfdata.resolve())
+    )
+    ntotal = invlists.merge_from_multiple(ils.data(), ils.size(), False, False)
+    logger.info("合并 {} 个索引，共 {} 个向量", len(sources), ntotal)
+
+    index.replace_invlists(invlists, True)
+    invlists.this.disown()
+    index.ntotal = ntotal
+    tmp = index_path.with_name(index_path.name + ".tmp")
+    faiss.write_index_binary(index, str(tmp))
+    tmp.replace(index_path)
+
+    del loaded
+    for path in old:
+        path.unlink()
+    return ntotal
@@ -0,0 +1,57 @@
+import faiss
+import numpy as np
+
+__all__ = ["PhashIndex"]
+
+
+class PhashIndex:
+    """
+    64 位感知哈希的多索引哈希（IndexBinaryMultiHash），用于查找汉明距离很小的近似重复图片
+
+    哈希分为 nhash 段分别建立哈希表，查询时每段最多翻转 nflip 位，
+    因此半径不超过 nhash * (nflip + 1) - 1 时结果是精确的
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray | None = None,
+        codes: np.ndarray | None = None,
+        nhash: int = 4,
+        nflip: int = 1,
+    ):
+        self.index = faiss.IndexBinaryMultiHash(64, nhash, 64 // nhash)
+        self.index.nflip = nflip
+        self.max_radius = nhash * (nflip + 1) - 1
+        # faiss 中的序号到图片 ID 的映射，按容量倍增
+        self._ids = np.empty(1024, dtype=np.int64)
+        if ids is not None and codes is not None:
+            self.add(ids, codes)
+
+    def __len__(self) -> int:
+        return self.index.ntotal
+
+    def add(self, ids: np.ndarray, codes: np.ndarray):
+        """
+        添加 n 张图片的哈希，codes 为 n×8 的 uint8 矩阵
+        """
+        n = len(self)
+        if n + len(ids) > len(self._ids):
+            grown = np.empty(max(2 * len(self._ids), n + len(ids)), dtype=np.int64)
+            grown[:n] = self._ids[:n]
+            self._ids = grown
+        self._ids[n : n + len(ids)] = ids
+        self.index.add(np.ascontiguousarray(codes, dtype=np.uint8))
+
+    def search(self, code: bytes, radius: int, limit: int = 1) -> list[tuple[int, int]]:
+        """
+        查找汉明距离不超过 radius 的最近 limit 张图片，按距离升序返回 [(图片 ID, 距离)]
+        """
+        if len(self) == 0 or radius < 0:
+            return []
+        if radius > self.max_radius:
+            raise ValueError(f"半径不能超过 {self.max_radius}")
+        query = np.frombuffer(code, dtype=np.uint8).reshape(1, 8)
+        # range_search 只返回距离严格小于半径的结果
+        _, distances, labels = self.index.range_search(query, radius + 1)
+        order = np.argsort(distances, kind="stable")[:limit]
+        return [(int(self._ids[labels[i]]), int(distances[i])) for i in order]
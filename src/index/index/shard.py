@@ -0,0 +1,93 @@
+from time import perf_counter
+
+import faiss
+import numpy as np
+
+from .index import (
+    FaissIndex,
+    FaissRawResult,
+    FaissSearchResult,
+    aggregate_matches,
+    scan_stats,
+    search_preassigned,
+)
+
+
+class ShardedFaissIndex:
+    """
+    按图片 ID 范围拆分的索引，各分片由同一个训练文件创建，共享相同的粗量化器
+
+    搜索时把所有分片的倒排表按分片顺序拼接成一个只读视图（HStackInvertedLists），
+    只做一次粗量化和一次搜索。分片覆盖递增的 ID 范围，拼接后每个倒排表中的向量顺序
+    与未分片的索引相同，因此距离相同时保留的近邻、max_codes 的扫描范围和统计信息
+    都与未分片的索引完全一致
+    """
+
+    def __init__(self, shards: list[FaissIndex]):
+        self.shards = shards
+        first = shards[0].index
+        # HStackInvertedLists 只保存指针，分片和指针数组需要与视图一起保留
+        self._invlists_ptrs = faiss.InvertedListsPtrVector()
+        for shard in shards:
+            self._invlists_ptrs.push_back(shard.index.invlists)
+        self._invlists = faiss.HStackInvertedLists(
+            self._invlists_ptrs.size(), self._invlists_ptrs.data()
+        )
+        self.index = faiss.IndexBinaryIVF(first.quantizer, first.d, first.nlist)
+        self.index.replace_invlists(self._invlists, False)
+        self.index.ntotal = sum(shard.index.ntotal for shard in shards)
+
+    @property
+    def list_sizes(self) -> np.ndarray:
+        return np.sum([shard.list_sizes for shard in self.shards], axis=0)
+
+    def imbalance(self) -> float:
+        arr = self.list_sizes
+        uf = np.sum(arr.astype(np.float64) ** 2)
+        tot = np.sum(arr).astype(np.float64)
+        return float(uf * len(arr) / tot**2)
+
+    def search(
+        self,
+        vectors: np.ndarray,
+        limit: int = 10,
+        k: int = 3,
+        nprobe: int = 1,
+        max_codes: int = 0,
+        efSearch: int = 16,
+        max_distance: int | None = None,
+    ) -> FaissSearchResult:
+        raw = self.search_raw(vectors, k, nprobe, max_codes, efSearch)
+        t0 = perf_counter()
+        kws = aggregate_matches(raw.labels, raw.distances, limit, max_distance)
+        return FaissSearchResult(
+            **raw.stats(), result=kws, aggregate_time=(perf_counter() - t0) * 1000
+        )
+
+    def search_raw(
+        self,
+        vectors: np.ndarray,
+        k: int = 3,
+        nprobe: int = 1,
+        max_codes: int = 0,
+        efSearch: int = 16,
+    ) -> FaissRawResult:
+        vectors = np.ascontiguousarray(vectors, dtype=np.uint8)
+
+        t0 = perf_counter()
+        coarse_dis, assign = self.shards[0].quantize(vectors, nprobe, efSearch)
+        t1 = perf_counter()
+        distances, labels = search_preassigned(
+            self.index, vectors, k, coarse_dis, assign, max_codes
+        )
+        t2 = perf_counter()
+
+        nlist, ndis = scan_stats(self.list_sizes, assign, max_codes)
+        return FaissRawResult(
+            distances=distances,
+            labels=labels,
+            nlist=nlist,
+            ndis=ndis,
+            quantization_time=(t1 - t0) * 1000,
+            search_time=(t2 - t1) * 1000,
+        )
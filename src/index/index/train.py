@@ -1,7 +1,9 @@
+import shutil
 from pathlib import Path
 
 import faiss
 import numpy as np
+from loguru import logger
 
 
 class FaissIndexTrainer:
@@ -39,6 +41,137 @@ class FaissIndexTrainer:
         self.index.clustering_index = clustering_index
         self.index.train(vectors)
 
+    @property
+    def checkpoint_dir(self) -> Path:
+        return self.db_dir / f"{self.description}.train.ckpt"
+
+    def train_hierarchical(
+        self, vectors: np.ndarray, niter: int = 25, seed: int = 1234
+    ):
+        """
+        使用两级 k-means 在 CPU 上训练索引
+
+        先将向量聚为 sqrt(k) 个一级簇，再按簇的大小分配二级聚类中心数量，在每个一级簇内单独聚类，
+        每次聚类都可以用满所有核心。每完成一个簇都会保存到 checkpoint_dir，中断后重新运行会跳过
+        已完成的部分（需要使用相同的训练向量）
+        """
+        if len(vectors) < self.k:
+            raise ValueError(f"训练向量数量 {len(vectors)} 少于聚类中心数量 {self.k}")
+        ckpt = self.checkpoint_dir
+        ckpt.mkdir(exist_ok=True)
+        k1 = max(1, round(np.sqrt(self.k)))
+
+        level1 = _load_or(
+            ckpt / "level1.npy", lambda: _kmeans(vectors, k1, niter, seed)
+        )
+        assign = _load_or(ckpt / "assign.npy", lambda: _assign(vectors, level1))
+        sizes = np.bincount(assign, minlength=k1)
+        k2 = _allocate(sizes, self.k)
+        logger.info("一级聚类完成，{} 个簇，最大 {} 个向量", k1, sizes.max())
+
+        order = np.argsort(assign, kind="stable")
+        bounds = np.concatenate([[0], np.cumsum(sizes)])
+        centroids = []
+        for i in range(k1):
+            if not k2[i]:
+                continue
+            members = vectors[order[bounds[i] : bounds[i + 1]]]
+            centroids.append(
+                _load_or(
+                    ckpt / f"level2_{i}.npy",
+                    lambda: _kmeans(members, int(k2[i]), niter, seed + i + 1),
+                )
+            )
+            if (i + 1) % 64 == 0:
+                logger.info("二级聚类进度 {}/{}", i + 1, k1)
+
+        self.index.quantizer.add(np.concatenate(centroids))
+        self.index.is_trained = True
+
+    def evaluate(self, vectors: np.ndarray) -> dict[str, float]:
+        """
+        用训练时未使用的向量评估聚类中心，返回倒排表的不平衡度、空表比例和最大长度
+        """
+        _, assign = self.index.quantizer.search(vectors, 1)
+        sizes = np.bincount(assign[:, 0], minlength=self.k).astype(np.float64)
+        return {
+            "imbalance": float(np.sum(sizes**2) * self.k / np.sum(sizes) ** 2),
+            "empty": float(np.mean(sizes == 0)),
+            "max": int(sizes.max()),
+        }
+
     def save(self):
         path = self.db_dir / f"{self.description}.train"
         faiss.write_index_binary(self.index, str(path))
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+
+
+def binary_to_real(vectors: np.ndarray) -> np.ndarray:
+    """
+    与 faiss 的 binary_to_real 相同，将每一位映射为 ±1
+    """
+    bits = np.unpackbits(vectors, axis=1, bitorder="little")
+    return bits.astype(np.float32) * 2 - 1
+
+
+def real_to_binary(vectors: np.ndarray) -> np.ndarray:
+    return np.packbits(vectors > 0, axis=1, bitorder="little")
+
+
+def _kmeans(vectors: np.ndarray, k: int, niter: int, seed: int) -> np.ndarray:
+    """
+    对二进制向量做 k-means，返回二值化后的聚类中心
+    """
+    if k >= len(vectors):
+        return vectors[:k].copy()
+    kmeans = faiss.Kmeans(FaissIndexTrainer.d, k, niter=niter, seed=seed)
+    # 超出 max_points_per_centroid 的部分由 faiss 采样，这里只转换需要的向量
+    limit = k * kmeans.cp.max_points_per_centroid
+    if len(vectors) > limit:
+        rng = np.random.default_rng(seed)
+        vectors = vectors[np.sort(rng.choice(len(vectors), limit, replace=False))]
+    kmeans.train(binary_to_real(vectors))
+    return real_to_binary(kmeans.centroids)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, chunk: int = 1 << 20):
+    """
+    按汉明距离将向量分配到最近的聚类中心
+    """
+    index = faiss.IndexBinaryFlat(FaissIndexTrainer.d)
+    index.add(centroids)
+    assign = np.empty(len(vectors), dtype=np.int64)
+    for i in range(0, len(vectors), chunk):
+        _, labels = index.search(vectors[i : i + chunk], 1)
+        assign[i : i + chunk] = labels[:, 0]
+    return assign
+
+
+def _allocate(sizes: np.ndarray, k: int) -> np.ndarray:
+    """
+    按一级簇的大小分配二级聚类中心数量，总数恰好为 k，每个非空簇至少 1 个且不超过簇的大小
+    """
+    k2 = np.minimum(np.maximum(sizes * k // sizes.sum(), sizes > 0), sizes)
+    while (diff := k - int(k2.sum())) != 0:
+        if diff > 0:
+            # 每个中心对应向量最多的簇优先增加
+            ratio = np.where(k2 < sizes, sizes / (k2 + 1), -1)
+            top = np.argsort(-ratio, kind="stable")[:diff]
+            k2[top[ratio[top] > 0]] += 1
+        else:
+            ratio = np.where(k2 > 1, sizes / k2, np.inf)
+            k2[np.argsort(ratio, kind="stable")[:-diff]] -= 1
+    return k2
+
+
+def _load_or(path: Path, compute) -> np.ndarray:
+    """
+    检查点存在时直接读取，否则计算并保存
+    """
+    if path.exists():
+        return np.load(path)
+    arr = compute()
+    tmp = path.with_suffix(".tmp.npy")
+    np.save(tmp, arr)
+    tmp.replace(path)
+    return arr
@@ -0,0 +1,160 @@
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Iterator
+
+import numpy as np
+
+__all__ = ["Histogram", "Metrics", "StageTimer"]
+
+# 延迟直方图的桶上界，单位秒
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+
+class StageTimer:
+    """
+    记录一次请求中各阶段的耗时，单位毫秒，同名阶段的耗时会累加
+    """
+
+    def __init__(self):
+        self.timings: dict[str, float] = {}
+        self.start = perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (perf_counter() - t0) * 1000)
+
+    def add(self, name: str, ms: float):
+        self.timings[name] = self.timings.get(name, 0.0) + ms
+
+    def finish(self) -> dict[str, float]:
+        """
+        记录从创建到现在的总耗时，返回保留两位小数的各阶段耗时
+        """
+        self.timings["total"] = (perf_counter() - self.start) * 1000
+        return {name: round(ms, 2) for name, ms in self.timings.items()}
+
+    def server_timing(self) -> str:
+        """
+        格式化为 Server-Timing 响应头
+        """
+        return ", ".join(f"{name};dur={ms:.2f}" for name, ms in self.timings.items())
+
+
+class Histogram:
+    """
+    线程安全的累积直方图，与 Prometheus 的 histogram 类型相同
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = int(np.searchsorted(self.buckets, value))
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def render(self, name: str, labels: dict[str, str]) -> list[str]:
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip([*self.buckets, float("inf")], counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(_sample(f"{name}_bucket", cumulative, {**labels, "le": le}))
+        lines.append(_sample(f"{name}_sum", total, labels))
+        lines.append(_sample(f"{name}_count", cumulative, labels))
+        return lines
+
+
+class Metrics:
+    """
+    服务的监控指标：各阶段的延迟直方图和计数器，以 Prometheus 文本格式输出
+
+    只统计当前进程，多 worker 时每个 worker 各自统计
+    """
+
+    def __init__(self, prefix: str = "index"):
+        self.prefix = prefix
+        self.stages: dict[str, Histogram] = {}
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, timings: dict[str, float]):
+        """
+        记录一次请求的各阶段耗时，单位毫秒
+        """
+        for stage, ms in timings.items():
+            if stage not in self.stages:
+                with self._lock:
+                    self.stages.setdefault(stage, Histogram())
+            self.stages[stage].observe(ms / 1000)
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(
+        self,
+        gauges: list[tuple[str, dict[str, str], float]],
+        counters: list[tuple[str, dict[str, str], float]] | None = None,
+    ) -> str:
+        """
+        输出所有指标，gauges 和 counters 为抓取时从其他组件读取的 [(名称, 标签, 值)]，
+        同名的样本需要相邻
+        """
+        p = self.prefix
+        lines = [
+            f"# HELP {p}_stage_duration_seconds 搜索请求各阶段的耗时",
+            f"# TYPE {p}_stage_duration_seconds histogram",
+        ]
+        for stage, hist in sorted(self.stages.items()):
+            lines += hist.render(f"{p}_stage_duration_seconds", {"stage": stage})
+
+        with self._lock:
+            own = sorted(self.counters.items())
+        samples = [
+            (name, dict(labels), value, "counter") for (name, labels), value in own
+        ]
+        samples += [
+            (name, labels, value, "counter") for name, labels, value in counters or []
+        ]
+        samples += [(name, labels, value, "gauge") for name, labels, value in gauges]
+        declared = set()
+        for name, labels, value, kind in samples:
+            if name not in declared:
+                lines.append(f"# TYPE {p}_{name} {kind}")
+                declared.add(name)
+            lines.append(_sample(f"{p}_{name}", value, labels))
+        return "\n".join(lines) + "\n"
+
+
+def _sample(name: str, value: float, labels: dict[str, str]) -> str:
+    if labels:
+        label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+        name = f"{name}{{{label_str}}}"
+    return f"{name} {value if isinstance(value, int) else float(value)!r}"
@@ -0,0 +1,232 @@
+import os
+import tarfile
+import threading
+import zipfile
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from pathlib import Path
+from queue import Queue
+from typing import BinaryIO, Iterator, NamedTuple
+
+import blake3
+from loguru import logger
+
+__all__ = [
+    "ARCHIVE_PATTERNS",
+    "ArchiveMember",
+    "ArchiveReader",
+    "ScanFile",
+    "list_members",
+    "read_path",
+    "scan_tree",
+]
+
+# 默认作为压缩包读取的文件
+ARCHIVE_PATTERNS = ["*.zip", "*.cbz", "*.tar", "*.cbt"]
+# 压缩包路径和其中文件名之间的分隔符
+ARCHIVE_SEP = "!"
+
+
+def _fingerprint(path: str, size: int, mtime: int, inode: int) -> bytes:
+    key = f"{path}\0{size}\0{mtime}\0{inode}"
+    return blake3.blake3(key.encode(errors="surrogateescape")).digest(8)
+
+
+class ScanFile(NamedTuple):
+    path: str
+    size: int
+    mtime: int
+    inode: int
+
+    @property
+    def fingerprint(self) -> bytes:
+        """
+        路径和 stat 信息的哈希，任意一项变化都会改变
+        """
+        return _fingerprint(self.path, self.size, self.mtime, self.inode)
+
+
+class ArchiveMember(NamedTuple):
+    """
+    压缩包中的一个文件，path 为 压缩包路径!文件名，size 为文件大小，mtime 和 inode 为压缩包的
+    """
+
+    path: str
+    size: int
+    mtime: int
+    inode: int
+    archive: ScanFile
+    member: str
+    # tar 中文件数据的偏移，zip 为 -1
+    offset: int
+    # 同一个压缩包中需要处理的文件数量
+    count: int = 0
+
+    @property
+    def fingerprint(self) -> bytes:
+        return _fingerprint(self.path, self.size, self.mtime, self.inode)
+
+
+def list_members(archive: ScanFile, patterns: list[str]) -> list[ArchiveMember]:
+    """
+    列出压缩包中文件名匹配任一 glob 表达式的文件，只读取 zip 的目录或 tar 的文件头
+
+    只支持未压缩的 tar，以便直接按偏移读取
+    """
+    members = []
+
+    def add(name: str, size: int, offset: int):
+        if any(fnmatchcase(name.rsplit("/", 1)[-1], p) for p in patterns):
+            path = f"{archive.path}{ARCHIVE_SEP}{name}"
+            members.append(
+                ArchiveMember(
+                    path, size, archive.mtime, archive.inode, archive, name, offset
+                )
+            )
+
+    if zipfile.is_zipfile(archive.path):
+        with zipfile.ZipFile(archive.path) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    add(info.filename, info.file_size, -1)
+    else:
+        with tarfile.open(archive.path, "r:") as tf:
+            for info in tf:
+                if info.isfile():
+                    add(info.name, info.size, info.offset_data)
+    return members
+
+
+class ArchiveReader:
+    """
+    读取文件或压缩包中的文件，缓存最近打开的 maxsize 个压缩包
+
+    每个 worker 各自打开压缩包，同一个压缩包中的文件可以由多个 worker 并行读取和解压
+    """
+
+    def __init__(self, maxsize: int = 4):
+        self.maxsize = maxsize
+        self._open: OrderedDict[str, zipfile.ZipFile | BinaryIO] = OrderedDict()
+
+    def read(self, file: ScanFile | ArchiveMember) -> bytes:
+        """
+        读取文件内容，失败时抛出 OSError
+        """
+        if isinstance(file, ScanFile):
+            return Path(file.path).read_bytes()
+        try:
+            handle = self._get(file)
+            if isinstance(handle, zipfile.ZipFile):
+                return handle.read(file.member)
+            handle.seek(file.offset)
+            data = handle.read(file.size)
+            if len(data) != file.size:
+                raise EOFError("压缩包不完整")
+            return data
+        except (
+            zipfile.BadZipFile,
+            zlib.error,
+            EOFError,
+            KeyError,
+            NotImplementedError,
+            RuntimeError,
+        ) as e:
+            raise OSError(e) from e
+
+    def _get(self, file: ArchiveMember) -> zipfile.ZipFile | BinaryIO:
+        path = file.archive.path
+        if (handle := self._open.get(path)) is not None:
+            self._open.move_to_end(path)
+            return handle
+        if file.offset < 0:
+            handle = zipfile.ZipFile(path)
+        else:
+            handle = open(path, "rb")
+        self._open[path] = handle
+        while len(self._open) > self.maxsize:
+            self._open.popitem(last=False)[1].close()
+        return handle
+
+    def close(self):
+        for handle in self._open.values():
+            handle.close()
+        self._open.clear()
+
+
+def read_path(path: str) -> bytes | None:
+    """
+    读取数据库中记录的图片路径，支持 压缩包路径!文件名 的形式，失败时返回 None
+    """
+    try:
+        return Path(path).read_bytes()
+    except OSError:
+        pass
+    archive, sep, member = path.partition(ARCHIVE_SEP)
+    # 压缩包路径本身可能含有分隔符
+    while sep and not os.path.isfile(archive):
+        head, sep, member = member.partition(ARCHIVE_SEP)
+        archive = f"{archive}{ARCHIVE_SEP}{head}"
+    if not sep:
+        return None
+    try:
+        if zipfile.is_zipfile(archive):
+            with zipfile.ZipFile(archive) as zf:
+                return zf.read(member)
+        with tarfile.open(archive, "r:") as tf:
+            f = tf.extractfile(member)
+            return f.read() if f is not None else None
+    except (OSError, zipfile.BadZipFile, tarfile.TarError, KeyError, RuntimeError):
+        return None
+
+
+def scan_tree(root: Path, patterns: list[str], workers: int = 8) -> Iterator[ScanFile]:
+    """
+    使用 workers 个线程并行遍历目录，流式返回文件名匹配任一 glob 表达式的文件
+
+    返回顺序不确定，不进入指向目录的符号链接
+    """
+    # 每个目录的文件作为一批放入队列，减少队列操作
+    output: Queue[list[ScanFile] | None] = Queue(maxsize=1000)
+    lock = threading.Lock()
+    # 已提交但尚未遍历完的目录数量，归零时遍历结束
+    pending = 0
+
+    def submit(path: str):
+        nonlocal pending
+        with lock:
+            pending += 1
+        executor.submit(visit, path)
+
+    def visit(path: str):
+        nonlocal pending
+        files = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        submit(entry.path)
+                    elif any(fnmatchcase(entry.name, p) for p in patterns):
+                        try:
+                            st = entry.stat()
+                        except OSError as e:
+                            logger.warning("无法读取文件 {}：{}", entry.path, e)
+                            continue
+                        files.append(
+                            ScanFile(entry.path, st.st_size, st.st_mtime_ns, st.st_ino)
+                        )
+        except OSError as e:
+            logger.warning("无法读取目录 {}：{}", path, e)
+        finally:
+            if files:
+                output.put(files)
+            with lock:
+                pending -= 1
+                if pending == 0:
+                    output.put(None)
+
+    with ThreadPoolExecutor(workers, "scan") as executor:
+        submit(str(root))
+        while (files := output.get()) is not None:
+            yield from files
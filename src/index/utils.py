@@ -1,25 +1,95 @@
+import threading
+from collections import OrderedDict
 from pathlib import Path
+from typing import Generic, Hashable, TypeVar
 
 import cv2
 import numpy as np
 from cv2.typing import MatLike
 
 
-def load_image(image: Path | str | bytes) -> MatLike | None:
+def load_image(
+    image: Path | str | bytes,
+    width: int = 1080,
+    height: int = 1920,
+    reduced: bool = True,
+) -> MatLike | None:
     """
     读取图片，转换为灰度图并缩放
+
+    reduced 为 True 时，对于远大于目标尺寸的 JPEG，先从文件头读取尺寸，然后直接以
+    1/2、1/4 或 1/8 的比例解码（libjpeg 的 DCT 缩放），再缩放到最终尺寸
     """
-    if isinstance(image, bytes):
-        buf = np.frombuffer(image, dtype=np.uint8)
-        img = cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE)
-    else:
-        img = cv2.imread(str(image), cv2.IMREAD_GRAYSCALE)
+    if not isinstance(image, bytes):
+        try:
+            image = Path(image).read_bytes()
+        except OSError:
+            return None
+    flags = cv2.IMREAD_GRAYSCALE
+    if reduced and (size := jpeg_size(image)) is not None:
+        flags = reduced_flag(*size, width, height)
+    img = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), flags)
     if img is None:
         return None
-    img = resize_image(img)
+    img = resize_image(img, width, height)
     return img
 
 
+# 缩小比例和对应的解码模式，按比例从大到小排列
+_REDUCED_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+]
+
+
+def reduced_flag(w: int, h: int, width: int = 1080, height: int = 1920) -> int:
+    """
+    选择解码后仍不小于 resize_image 目标尺寸的最大缩小比例
+
+    文件头中的尺寸没有应用 EXIF 方向，因此按横竖两种方向中缩放比例较大的一种计算
+    """
+    scale = max(min(width / w, height / h), min(width / h, height / w))
+    for denom, flag in _REDUCED_FLAGS:
+        if scale * denom <= 1:
+            return flag
+    return cv2.IMREAD_GRAYSCALE
+
+
+# 带有图片尺寸的 SOF 段，不包括 DHT（C4）、JPG（C8）和 DAC（CC）
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7}
+_SOF_MARKERS |= {0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(data: bytes) -> tuple[int, int] | None:
+    """
+    从 JPEG 文件头中读取 (宽, 高)，不是 JPEG 或文件头损坏时返回 None
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # 段之间的填充字节
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        if marker in _SOF_MARKERS:
+            h = int.from_bytes(data[i + 5 : i + 7], "big")
+            w = int.from_bytes(data[i + 7 : i + 9], "big")
+            return (w, h) if w and h else None
+        if marker == 0xDA:
+            # 扫描数据开始之前没有找到 SOF 段
+            return None
+        i += 2 + int.from_bytes(data[i + 2 : i + 4], "big")
+    return None
+
+
 def resize_image(img: MatLike, width: int = 1080, height: int = 1920) -> MatLike:
     """
     将图片按照宽度等比例缩放
@@ -30,3 +100,60 @@ def resize_image(img: MatLike, width: int = 1080, height: int = 1920) -> MatLike
     else:
         scale = min(width / w, height / h)
         return cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def memory_usage() -> dict[str, int] | None:
+    """
+    读取当前进程的内存占用（字节），包括常驻、与其他进程共享和私有的部分，仅支持 Linux
+    """
+    try:
+        lines = Path("/proc/self/smaps_rollup").read_text().splitlines()
+    except OSError:
+        return None
+    fields = {}
+    for line in lines[1:]:
+        key, value, *_ = line.split()
+        fields[key.rstrip(":")] = int(value) * 1024
+    return {
+        "rss": fields["Rss"],
+        "shared": fields["Shared_Clean"] + fields["Shared_Dirty"],
+        "private": fields["Private_Clean"] + fields["Private_Dirty"],
+    }
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    线程安全的 LRU 缓存，记录命中和未命中次数
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[K, V] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: K, value: V):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)